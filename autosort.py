@@ -25,6 +25,32 @@
 
 #
 # Changelog:
+# 3.11:
+#   * Insert newly opened buffers into the sorted list without a full sort.
+#   * Cache sort keys between sorts and invalidate them when buffers change.
+#   * Only move buffers that are out of place when applying the sorted order.
+#   * Only evaluate later rules for buffers that are tied on the earlier rules.
+#   * Only evaluate helpers that are used by the rules.
+#   * Allow helpers to use other helpers.
+#   * Compile common rules and helpers to python instead of evaluating them with weechat.
+#   * Evaluate autosort info hooks in compiled rules without going through weechat.
+#   * Parse and escape info hook arguments in linear time.
+#   * Fix signal_delay not preventing multiple sorts when many signals arrive at once.
+#   * Suspend sorting while IRC servers connect and join channels.
+#   * Adapt signal_delay and sort_limit to the measured sort duration and signal rate.
+#   * Evaluate sort keys in time slices for large buffer lists, so sorting doesn't freeze weechat.
+#   * Read the buffer properties used by compiled rules in a single pass over the buffer list.
+#   * Store sort keys as tuples of interned strings, so repeated values are shared and compare faster.
+#   * Evaluate rules and helpers only once per sort for buffers that have the same inputs.
+#   * Only re-evaluate the rules that read a changed buffer property, and don't sort if no rule result changed.
+#   * Skip sorting if the buffers are already in order.
+#   * Only sort the partitions of the buffer list that are out of order, see autosort.sorting.partition_rules.
+#   * Add /autosort profile to show how much time each rule, helper and sorting phase takes.
+#   * Add the autosort_stats info with counters and sort durations as JSON.
+#   * Add /autosort dump to write the buffer list and sort configuration to a file for offline profiling.
+#   * Remember the sorted order across restarts and move known buffers into place as soon as they are opened.
+#   * Only redo the work that a changed option requires when the configuration changes.
+#   * Fix signal hooks piling up with every configuration change, and add /autosort hooks to list them.
 # 3.10:
 #   * Fix exception in `/autosort helpers swap`.
 # 3.9:
@@ -80,8 +106,12 @@
 #
 
 
+import bisect
+import collections
+import itertools
 import json
 import math
+import os
 import re
 import sys
 import time
@@ -89,16 +119,46 @@ import weechat
 
 SCRIPT_NAME     = 'autosort'
 SCRIPT_AUTHOR   = 'Maarten de Vries <maarten@de-vri.es>'
-SCRIPT_VERSION  = '3.10'
+SCRIPT_VERSION  = '3.11'
 SCRIPT_LICENSE  = 'GPL3'
 SCRIPT_DESC     = 'Flexible automatic (or manual) buffer sorting based on eval expressions.'
 
 
 config             = None
-hooks              = []
-signal_delay_timer = None
-sort_limit_timer   = None
-sort_queued        = False
+hooks              = {}
+scheduler          = None
+buffer_order       = None
+pending_buffers    = []
+pending_full_sort  = False
+key_cache          = {}
+sort_job           = None
+stats              = None
+order_memory       = None
+order_save_timer   = None
+sort_generation    = 0
+
+# Signals that start and end a burst of new buffers, like joining channels after connecting to a server.
+burst_start_signals = ['irc_server_connecting']
+burst_end_signals   = ['irc_server_connected', 'irc_server_disconnected']
+
+# Signals that change buffer properties which rules can read.
+property_signals = [
+	'buffer_renamed',
+	'buffer_localvar_added',
+	'buffer_localvar_changed',
+	'buffer_localvar_removed',
+]
+
+# Signals that can change the sort key of a buffer.
+invalidating_signals = [
+	'buffer_renamed',
+	'buffer_localvar_added',
+	'buffer_localvar_changed',
+	'buffer_localvar_removed',
+	'buffer_merged',
+	'buffer_unmerged',
+	'buffer_closed',
+]
 
 
 # Make sure that unicode, bytes and str are always available in python2 and 3.
@@ -125,6 +185,13 @@ if hasattr(time, 'perf_counter'):
 else:
 	perf_counter = time.clock
 
+if hasattr(sys, 'intern'):
+	intern_string = sys.intern
+else:
+	def intern_string(string):
+		# Python 2 can only intern byte strings.
+		return intern(string) if isinstance(string, str) else string
+
 def casefold(string):
 	if hasattr(string, 'casefold'): return string.casefold()
 	# Fall back to lowercasing for python2.
@@ -177,6 +244,366 @@ def decode_helpers(blob):
 			return {}
 	return parsed
 
+def referenced_helpers(expression, helpers):
+	''' Get the names of the helpers referenced by an expression. '''
+	# If variable names are built dynamically, any helper could be referenced.
+	if re.search(r'\$\{[^{}:]*\$\{', expression) or '${eval' in expression:
+		return set(helpers)
+	return set(name for name in helpers if '${' + name + '}' in expression)
+
+class HelperGraph:
+	'''
+	The dependencies of rules and helpers on other helpers.
+
+	For each helper, `dependencies` holds the helpers it references directly.
+	For each rule, `rule_helpers` holds all helpers it needs in the order they must be evaluated.
+	Helpers that aren't needed by any rule don't appear in `rule_helpers`.
+	'''
+	def __init__(self, rules, helpers):
+		self.dependencies = {}
+		self.rule_helpers = []
+
+		references = dict((name, referenced_helpers(expression, helpers)) for name, expression in helpers.items())
+		order      = []
+		state      = {}
+
+		def visit(name):
+			state[name] = 'visiting'
+			dependencies = []
+			for dependency in sorted(references[name]):
+				if state.get(dependency) == 'visiting':
+					log('Helper "{0}" depends on itself through "{1}". That reference is ignored.'.format(dependency, name))
+					continue
+				if dependency not in state: visit(dependency)
+				dependencies.append(dependency)
+			self.dependencies[name] = dependencies
+			state[name] = 'done'
+			order.append(name)
+
+		for name in sorted(helpers):
+			if name not in state: visit(name)
+
+		position = dict((name, i) for i, name in enumerate(order))
+		for rule in rules:
+			needed = set()
+			todo   = list(referenced_helpers(rule, helpers))
+			while todo:
+				name = todo.pop()
+				if name in needed: continue
+				needed.add(name)
+				todo.extend(self.dependencies[name])
+			self.rule_helpers.append(sorted(needed, key=lambda name: position[name]))
+
+class UnsupportedExpression(Exception):
+	''' Raised when an eval expression can not be compiled. '''
+	pass
+
+# Names that weechat resolves to something other than a local variable.
+special_variables = set(['buffer', 'window', 'date'])
+
+strtod_pattern = re.compile(
+	r'[ \t\n\v\f\r]*[+-]?(?:'
+	r'(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:e[+-]?[0-9]+)?'
+	r'|0x(?:[0-9a-f]+\.?[0-9a-f]*|\.[0-9a-f]+)(?:p[+-]?[0-9]+)?'
+	r'|inf(?:inity)?'
+	r'|nan(?:\([0-9a-z_]*\))?'
+	r')\Z',
+	re.IGNORECASE
+)
+
+def eval_strtod(value):
+	''' Parse a number like weechat does for comparisons, or return None if it isn't a number. '''
+	if not value: return 0.0
+	if not strtod_pattern.match(value): return None
+	value = value.strip().lower()
+	if 'x' in value: return float.fromhex(value)
+	if 'nan' in value: return float('nan')
+	return float(value)
+
+def eval_equal(left, right):
+	''' Compare two values like the == operator in weechat conditions. '''
+	def quoted(value):
+		return not value or (len(value) >= 2 and value[0] == '"' and value[-1] == '"')
+
+	if not (quoted(left) and quoted(right)):
+		a = eval_strtod(left)
+		b = eval_strtod(right) if a is not None else None
+		if b is not None: return not (a < b or a > b)
+	return left == right
+
+def find_closing(text, start):
+	''' Find the closing brace of a ${ that ends right before text[start]. '''
+	level = 1
+	i     = start
+	while i < len(text):
+		if text.startswith('${', i):
+			level += 1
+			i     += 2
+			continue
+		if text[i] == '}':
+			level -= 1
+			if level == 0: return i
+		i += 1
+	raise UnsupportedExpression('unterminated variable')
+
+def split_template(text):
+	''' Split an eval string in a list of (literal, text) tuples for literal text and the contents of ${...} variables. '''
+	result = []
+	i = 0
+	while i < len(text):
+		start = text.find('${', i)
+		if start < 0: start = len(text)
+		if start > i: result.append((True, text[i:start]))
+		if start == len(text): break
+		end = find_closing(text, start + 2)
+		result.append((False, text[start + 2:end]))
+		i = end + 1
+	return result
+
+def find_top_level(text, needle):
+	''' Find a string in the literal text of an eval string, outside of ${...} variables. '''
+	offset = 0
+	for literal, part in split_template(text):
+		if literal:
+			i = part.find(needle)
+			if i >= 0: return offset + i
+			offset += len(part)
+		else:
+			offset += len(part) + 3
+	return -1
+
+class CompileScope:
+	'''
+	The helpers visible to an expression being compiled, and the inputs it reads.
+	Inputs are ('helper', name), ('buffer', property) or ('localvar', name) tuples.
+	'''
+	def __init__(self, helpers):
+		self.helpers = helpers
+		self.inputs  = set()
+
+def read_input(buffer, extra_vars, input):
+	''' Read one input of a compiled expression from a BufferInfo or the extra variables. '''
+	kind, name = input
+	if kind == 'helper':   return extra_vars[name]
+	if kind == 'localvar': return buffer.localvars.get(name, '')
+	return getattr(buffer, name)
+
+def compile_constant(value):
+	return lambda buffer, extra_vars: value
+
+def compile_template(text, scope):
+	'''
+	Compile an eval string to a function taking a BufferInfo and a dictionary of extra variables.
+	Raises UnsupportedExpression for anything that isn't understood.
+	'''
+	parts = []
+	for literal, part in split_template(text):
+		parts.append(compile_constant(part) if literal else compile_variable(part, scope))
+
+	if not parts: return compile_constant('')
+	if len(parts) == 1: return parts[0]
+	return lambda buffer, extra_vars: ''.join([part(buffer, extra_vars) for part in parts])
+
+def compile_variable(name, scope):
+	''' Compile the contents of a ${...} variable. '''
+	if name in scope.helpers:
+		scope.inputs.add(('helper', name))
+		return lambda buffer, extra_vars: extra_vars[name]
+	if name.startswith('if:'):
+		return compile_if(name[3:], scope)
+	if name.startswith('info:'):
+		return compile_info(name[5:], scope)
+	if '${' in name or ':' in name:
+		raise UnsupportedExpression('unsupported variable: ${{{0}}}'.format(name))
+
+	if name in ('buffer.full_name', 'buffer.name', 'buffer.short_name'):
+		field = name[len('buffer.'):]
+		scope.inputs.add(('buffer', field))
+		return lambda buffer, extra_vars: getattr(buffer, field)
+	if name.startswith('buffer.local_variables.'):
+		name = name[len('buffer.local_variables.'):]
+	elif '.' in name or name in special_variables or name.startswith('weechat_'):
+		raise UnsupportedExpression('unsupported variable: ${{{0}}}'.format(name))
+
+	if not re.match(r'[\w-]+\Z', name):
+		raise UnsupportedExpression('unsupported local variable: {0}'.format(name))
+	scope.inputs.add(('localvar', name))
+	return lambda buffer, extra_vars: buffer.localvars.get(name, '')
+
+def compile_info(text, scope):
+	''' Compile an ${info:name,arguments} variable. '''
+	comma = text.find(',')
+	if comma < 0 or '${' in text[:comma]:
+		raise UnsupportedExpression('unsupported info: {0}'.format(text))
+	name      = text[:comma]
+	arguments = text[comma + 1:]
+
+	# Our own info hooks are evaluated in-process instead of going through weechat.
+	if name == 'autosort_escape':
+		value = compile_template(arguments, scope)
+		return lambda buffer, extra_vars: escape_arg(value(buffer, extra_vars))
+	if name == 'autosort_replace':
+		return compile_replace(arguments, scope)
+	if name == 'autosort_order':
+		return compile_order(arguments, scope)
+
+	arguments = compile_template(arguments, scope)
+	return lambda buffer, extra_vars: weechat.info_get(name, arguments(buffer, extra_vars))
+
+ARGUMENT_LITERAL = 0
+ARGUMENT_ESCAPED = 1
+ARGUMENT_RAW     = 2
+
+def split_arguments(text, scope):
+	'''
+	Split the arguments of an autosort info hook at compile time.
+
+	The result is a list of arguments, each being a list of (kind, part) tuples.
+	Literal parts are strings, the other parts are compiled functions.
+	Variables wrapped in ${info:autosort_escape} can never contain an argument separator.
+	Other variables are raw: they may contain commas or backslashes once expanded.
+	'''
+	escape_prefix = 'info:autosort_escape,'
+	arguments = [[]]
+	for literal, part in split_template(text):
+		if literal:
+			pieces = part.split(',')
+			arguments[-1].append((ARGUMENT_LITERAL, pieces[0]))
+			arguments.extend([[(ARGUMENT_LITERAL, piece)] for piece in pieces[1:]])
+		elif part.startswith(escape_prefix) and part not in scope.helpers:
+			arguments[-1].append((ARGUMENT_ESCAPED, compile_template(part[len(escape_prefix):], scope)))
+		else:
+			arguments[-1].append((ARGUMENT_RAW, compile_variable(part, scope)))
+	return arguments
+
+def compile_arguments(arguments):
+	'''
+	Compile arguments split by split_arguments.
+
+	The compiled function returns a tuple (arguments, text).
+	Normally, arguments is the list of expanded arguments and text is None.
+	If a raw variable expands to something with a comma or backslash,
+	arguments is None and text is the full argument string to be parsed with parse_args.
+	'''
+	def evaluate(buffer, extra_vars):
+		expanded = [[(kind, part if kind == ARGUMENT_LITERAL else part(buffer, extra_vars)) for kind, part in argument] for argument in arguments]
+		for argument in expanded:
+			for kind, value in argument:
+				if kind == ARGUMENT_RAW and (',' in value or '\\' in value):
+					return None, ','.join(''.join(escape_arg(value) if kind == ARGUMENT_ESCAPED else value for kind, value in argument) for argument in expanded)
+		return [''.join(value for kind, value in argument) for argument in expanded], None
+	return evaluate
+
+def compile_replace(text, scope):
+	''' Compile an ${info:autosort_replace,old,new,text} variable. '''
+	arguments = compile_arguments(split_arguments(text, scope))
+	def evaluate(buffer, extra_vars):
+		expanded, text = arguments(buffer, extra_vars)
+		if expanded is None: return on_info_replace('', 'autosort_replace', text)
+		rest = ','.join(expanded[3:]) if len(expanded) > 3 else None
+		return info_replace('autosort_replace', expanded[:3], rest)
+	return evaluate
+
+def compile_order(text, scope):
+	'''
+	Compile an ${info:autosort_order,value,first,second,...} variable.
+	If the options are literal text, the lookup table is computed once here.
+	'''
+	arguments = split_arguments(text, scope)
+	options   = arguments[1:]
+	if not all(kind == ARGUMENT_LITERAL for option in options for kind, part in option):
+		expanded = compile_arguments(arguments)
+		def evaluate(buffer, extra_vars):
+			arguments, text = expanded(buffer, extra_vars)
+			if arguments is None: return on_info_order('', 'autosort_order', text)
+			return info_order('autosort_order', arguments)
+		return evaluate
+
+	options = [''.join(part for kind, part in option) for option in options]
+	table   = OrderTable(options)
+	value   = compile_arguments(arguments[:1])
+	def evaluate(buffer, extra_vars):
+		arguments, text = value(buffer, extra_vars)
+		if arguments is None: return on_info_order('', 'autosort_order', ','.join([text] + options))
+		return table.lookup(arguments[0])
+	return evaluate
+
+def compile_if(text, scope):
+	''' Compile an ${if:condition?then:else} variable. '''
+	question = find_top_level(text, '?')
+	if question < 0:
+		condition = compile_condition(text, scope)
+		return lambda buffer, extra_vars: '1' if condition(buffer, extra_vars) else '0'
+
+	condition = compile_condition(text[:question], scope)
+	branches  = text[question + 1:]
+	colon     = find_top_level(branches, ':')
+	if colon < 0:
+		then = compile_template(branches, scope)
+		return lambda buffer, extra_vars: then(buffer, extra_vars) if condition(buffer, extra_vars) else ''
+
+	then      = compile_template(branches[:colon], scope)
+	otherwise = compile_template(branches[colon + 1:], scope)
+	return lambda buffer, extra_vars: then(buffer, extra_vars) if condition(buffer, extra_vars) else otherwise(buffer, extra_vars)
+
+def compile_condition(text, scope):
+	'''
+	Compile a condition of an ${if:...} variable to a function returning a boolean.
+	Only a single == or != comparison or a plain value is supported.
+	'''
+	text     = text.strip(' ')
+	literals = [part for literal, part in split_template(text) if literal]
+	for operator in ('=~', '!~', '=*', '!*', '=-', '!-', '<', '>', '&&', '||', '(', ')'):
+		if any(operator in part for part in literals):
+			raise UnsupportedExpression('unsupported condition: {0}'.format(text))
+
+	count = sum(part.count('==') + part.count('!=') for part in literals)
+	if count == 0:
+		value = compile_template(text, scope)
+		return lambda buffer, extra_vars: value(buffer, extra_vars) not in ('', '0')
+	if count > 1:
+		raise UnsupportedExpression('unsupported condition: {0}'.format(text))
+
+	position = find_top_level(text, '==')
+	negate   = position < 0
+	if negate: position = find_top_level(text, '!=')
+	left  = compile_template(text[:position].strip(' '), scope)
+	right = compile_template(text[position + 2:].strip(' '), scope)
+	if negate:
+		return lambda buffer, extra_vars: not eval_equal(left(buffer, extra_vars), right(buffer, extra_vars))
+	return lambda buffer, extra_vars: eval_equal(left(buffer, extra_vars), right(buffer, extra_vars))
+
+class Expression:
+	'''
+	A rule or helper expression.
+
+	If possible, the expression is compiled to a python function that reads the properties of a BufferInfo.
+	Otherwise it is evaluated with weechat.string_eval_expression.
+	Either way, `evaluate(buffer, extra_vars)` gives the same result for a BufferInfo.
+
+	A compiled expression only depends on its inputs, so its result can be reused for buffers with the same inputs.
+	`memo_inputs` is the sorted list of inputs if that is worth it, or None otherwise.
+	It isn't worth it for uncompiled expressions, expressions that read buffer names
+	(which are different for every buffer) or expressions that only read a single variable.
+	'''
+	def __init__(self, expression, visible_helpers):
+		self.expression  = expression
+		self.compiled    = True
+		self.error       = None
+		self.inputs      = None
+		self.memo_inputs = None
+		try:
+			if '\\' in expression: raise UnsupportedExpression('backslashes are not supported')
+			scope         = CompileScope(visible_helpers)
+			self.evaluate = compile_template(expression, scope)
+			self.inputs   = sorted(scope.inputs)
+			if not any(kind == 'buffer' for kind, name in self.inputs) and not re.match(r'\$\{[^${}]*\}\Z', expression):
+				self.memo_inputs = self.inputs
+		except UnsupportedExpression as e:
+			self.compiled = False
+			self.error    = e.args[0]
+			self.evaluate = lambda buffer, extra_vars: weechat.string_eval_expression(expression, {"buffer": buffer.pointer}, extra_vars, {})
+
 class Config:
 	''' The autosort configuration. '''
 
@@ -199,11 +626,21 @@ class Config:
 		'script_or_plugin': '${if:${script_name}?${script_name}:${plugin}}',
 	})
 
-	default_signal_delay = 5
-	default_sort_limit   = 100
+	default_signal_delay       = 5
+	default_sort_limit         = 100
+	default_cpu_share          = 5
+	default_max_delay          = 5000
+	default_time_slice         = 50
+	default_partition_rules    = 5
+	default_burst_quiet_period = 1000
+	default_burst_max_duration = 30000
 
 	default_signals = 'buffer_opened buffer_merged buffer_unmerged buffer_renamed'
 
+	# Attributes that change the sort keys, or the timing of automatic sorting, when they change.
+	key_options    = frozenset(['rules', 'helpers', 'case_sensitive'])
+	timing_options = frozenset(['signal_delay', 'sort_limit', 'cpu_share', 'max_delay', 'burst_quiet', 'burst_max'])
+
 	def __init__(self, filename):
 		''' Initialize the configuration. '''
 
@@ -213,22 +650,42 @@ class Config:
 		self.v3_section       = None
 
 		self.case_sensitive   = False
+		self.rules_blob       = None
+		self.helpers_blob     = None
 		self.rules            = []
 		self.helpers          = {}
+		self.helper_graph     = HelperGraph([], {})
+		self.compiled_rules   = []
+		self.compiled_helpers = {}
+		self.rule_inputs      = []
 		self.signals          = []
-		self.signal_delay     = Config.default_signal_delay,
-		self.sort_limit       = Config.default_sort_limit,
+		self.signal_delay     = Config.default_signal_delay
+		self.sort_limit       = Config.default_sort_limit
+		self.cpu_share        = Config.default_cpu_share
+		self.max_delay        = Config.default_max_delay
+		self.time_slice       = Config.default_time_slice
+		self.partition_rules  = Config.default_partition_rules
+		self.burst_quiet      = Config.default_burst_quiet_period
+		self.burst_max        = Config.default_burst_max_duration
+		self.remember_order   = True
 		self.sort_on_config   = True
 		self.debug_log        = False
 
-		self.__case_sensitive = None
-		self.__rules          = None
-		self.__helpers        = None
-		self.__signals        = None
-		self.__signal_delay   = None
-		self.__sort_limit     = None
-		self.__sort_on_config = None
-		self.__debug_log      = None
+		self.__case_sensitive  = None
+		self.__rules           = None
+		self.__helpers         = None
+		self.__signals         = None
+		self.__signal_delay    = None
+		self.__sort_limit      = None
+		self.__cpu_share       = None
+		self.__max_delay       = None
+		self.__time_slice      = None
+		self.__partition_rules = None
+		self.__burst_quiet     = None
+		self.__burst_max       = None
+		self.__remember_order  = None
+		self.__sort_on_config  = None
+		self.__debug_log       = None
 
 		if not self.config_file:
 			log('Failed to initialize configuration file "{0}".'.format(self.filename))
@@ -306,10 +763,66 @@ class Config:
 			'', '', '', '', '', ''
 		)
 
+		self.__cpu_share = weechat.config_new_option(
+			self.config_file, self.sorting_section,
+			'cpu_share', 'integer',
+			'Maximum percentage of time to spend sorting. The signal_delay and sort_limit are raised up to max_delay when sorting takes long or signals arrive quickly, based on the average sort duration and signal rate. Set to 0 to always use signal_delay and sort_limit as configured.',
+			'', 0, 100, str(Config.default_cpu_share), str(Config.default_cpu_share), 0,
+			'', '', '', '', '', ''
+		)
+
+		self.__max_delay = weechat.config_new_option(
+			self.config_file, self.sorting_section,
+			'max_delay', 'integer',
+			'Upper bound in milliseconds for the signal delay and sort limit when they are raised because of cpu_share. The configured signal_delay and sort_limit are used as lower bound.',
+			'', 0, 60000, str(Config.default_max_delay), str(Config.default_max_delay), 0,
+			'', '', '', '', '', ''
+		)
+
+		self.__time_slice = weechat.config_new_option(
+			self.config_file, self.sorting_section,
+			'time_slice', 'integer',
+			'Maximum time in milliseconds to block weechat while evaluating sort keys for an automatic sort. If evaluating takes longer, the remaining buffers are evaluated in the next time slices and the new order is applied once all keys are known. Set to 0 to always sort in one go.',
+			'', 0, 1000, str(Config.default_time_slice), str(Config.default_time_slice), 0,
+			'', '', '', '', '', ''
+		)
+
+		self.__partition_rules = weechat.config_new_option(
+			self.config_file, self.sorting_section,
+			'partition_rules', 'integer',
+			'Number of leading sort rules that split the buffer list in independent partitions, for example one per server with the default rules. If the partitions are already in order, only the partitions that are out of order are sorted. Set to 0 to always sort the whole buffer list.',
+			'', 0, 1000, str(Config.default_partition_rules), str(Config.default_partition_rules), 0,
+			'', '', '', '', '', ''
+		)
+
+		self.__burst_quiet = weechat.config_new_option(
+			self.config_file, self.sorting_section,
+			'burst_quiet_period', 'integer',
+			'While an IRC server is connecting, sorting is suspended until the server is connected and no signal arrived for this many milliseconds. This prevents sorting over and over while channels are joined. Set to 0 to disable.',
+			'', 0, 60000, str(Config.default_burst_quiet_period), str(Config.default_burst_quiet_period), 0,
+			'', '', '', '', '', ''
+		)
+
+		self.__burst_max = weechat.config_new_option(
+			self.config_file, self.sorting_section,
+			'burst_max_duration', 'integer',
+			'Maximum time in milliseconds that sorting is suspended while IRC servers are connecting. Set to 0 to disable suspending sorting.',
+			'', 0, 600000, str(Config.default_burst_max_duration), str(Config.default_burst_max_duration), 0,
+			'', '', '', '', '', ''
+		)
+
+		self.__remember_order = weechat.config_new_option(
+			self.config_file, self.sorting_section,
+			'remember_order', 'boolean',
+			'Remember the sorted order of the buffers in autosort_order.json in the weechat data directory, and move buffers that were seen before to their remembered position as soon as they are opened. This avoids moving buffers over and over while weechat starts or a server reconnects.',
+			'', 0, 0, 'on', 'on', 0,
+			'', '', '', '', '', ''
+		)
+
 		self.__sort_on_config = weechat.config_new_option(
 			self.config_file, self.sorting_section,
 			'sort_on_config_change', 'boolean',
-			'Decides if the buffer list should be sorted when autosort configuration changes.',
+			'Decides if the buffer list should be sorted when the sort rules, helpers or case sensitivity change.',
 			'', 0, 0, 'on', 'on', 0,
 			'', '', '', '', '', ''
 		)
@@ -331,29 +844,88 @@ class Config:
 		self.reload()
 
 	def reload(self):
-		''' Load configuration variables. '''
-
-		self.case_sensitive = weechat.config_boolean(self.__case_sensitive)
-
-		rules_blob    = weechat.config_string(self.__rules)
-		helpers_blob  = weechat.config_string(self.__helpers)
-		signals_blob  = weechat.config_string(self.__signals)
+		'''
+		Load configuration variables.
+
+		Returns the set of the names of the attributes that changed.
+		The rules and helpers are only parsed and compiled again if their JSON changed,
+		and any change to their JSON counts as a change of the rules or helpers.
+		'''
+		values = collections.OrderedDict([
+			('case_sensitive',  weechat.config_boolean(self.__case_sensitive)),
+			('rules_blob',      weechat.config_string(self.__rules)),
+			('helpers_blob',    weechat.config_string(self.__helpers)),
+			('signals',         weechat.config_string(self.__signals).split()),
+			('signal_delay',    weechat.config_integer(self.__signal_delay)),
+			('sort_limit',      weechat.config_integer(self.__sort_limit)),
+			('cpu_share',       weechat.config_integer(self.__cpu_share)),
+			('max_delay',       weechat.config_integer(self.__max_delay)),
+			('time_slice',      weechat.config_integer(self.__time_slice)),
+			('partition_rules', weechat.config_integer(self.__partition_rules)),
+			('burst_quiet',     weechat.config_integer(self.__burst_quiet)),
+			('burst_max',       weechat.config_integer(self.__burst_max)),
+			('remember_order',  weechat.config_boolean(self.__remember_order)),
+			('sort_on_config',  weechat.config_boolean(self.__sort_on_config)),
+			('debug_log',       weechat.config_boolean(self.__debug_log)),
+		])
+
+		changed = set(name for name, value in values.items() if getattr(self, name) != value)
+		for name in changed:
+			setattr(self, name, values[name])
+
+		# Compare the JSON rather than the decoded values, which could have been edited in place.
+		if 'rules_blob' in changed or 'helpers_blob' in changed:
+			if 'rules_blob'   in changed: changed.add('rules')
+			if 'helpers_blob' in changed: changed.add('helpers')
+			changed.discard('rules_blob')
+			changed.discard('helpers_blob')
+
+			self.rules          = decode_rules(self.rules_blob)
+			self.helpers        = decode_helpers(self.helpers_blob)
+			self.helper_graph   = HelperGraph(self.rules, self.helpers)
+			self.compiled_rules = [Expression(rule, set(self.helpers)) for rule in self.rules]
+			self.compiled_helpers = dict(
+				(name, Expression(helper, set(self.helper_graph.dependencies[name])))
+				for name, helper in self.helpers.items()
+			)
+			self.rule_inputs = [self.read_properties(i) for i in range(len(self.rules))]
+
+		# Cached sort keys are only valid for the rules they were computed with.
+		if not changed.isdisjoint(Config.key_options):
+			key_cache.clear()
+
+		return changed
+
+	def read_properties(self, rule):
+		'''
+		Get the set of buffer properties and local variables that a rule reads, including through helpers.
+		Returns None if the rule or one of its helpers isn't compiled, since it can read anything.
+		'''
+		expressions = [self.compiled_rules[rule]]
+		expressions.extend(self.compiled_helpers[name] for name in self.helper_graph.rule_helpers[rule])
+		result = set()
+		for expression in expressions:
+			if expression.inputs is None: return None
+			result.update(input for input in expression.inputs if input[0] != 'helper')
+		return result
 
-		self.rules          = decode_rules(rules_blob)
-		self.helpers        = decode_helpers(helpers_blob)
-		self.signals        = signals_blob.split()
-		self.signal_delay   = weechat.config_integer(self.__signal_delay)
-		self.sort_limit     = weechat.config_integer(self.__sort_limit)
-		self.sort_on_config = weechat.config_boolean(self.__sort_on_config)
-		self.debug_log      = weechat.config_boolean(self.__debug_log)
+	def rules_reading(self, changed):
+		''' Get the indices of the rules that can read any of the given changed inputs. '''
+		return [i for i, inputs in enumerate(self.rule_inputs) if inputs is None or not inputs.isdisjoint(changed)]
 
-	def save_rules(self, run_callback = True):
-		''' Save the current rules to the configuration. '''
-		weechat.config_option_set(self.__rules, json.dumps(self.rules), run_callback)
+	def save_rules(self, rules, run_callback = True):
+		'''
+		Save new rules to the configuration.
+		The rules are only changed by reload(), so it can tell what changed. Don't edit self.rules in place.
+		'''
+		weechat.config_option_set(self.__rules, json.dumps(rules), run_callback)
 
-	def save_helpers(self, run_callback = True):
-		''' Save the current helpers to the configuration. '''
-		weechat.config_option_set(self.__helpers, json.dumps(self.helpers), run_callback)
+	def save_helpers(self, helpers, run_callback = True):
+		'''
+		Save new helpers to the configuration.
+		The helpers are only changed by reload(), so it can tell what changed. Don't edit self.helpers in place.
+		'''
+		weechat.config_option_set(self.__helpers, json.dumps(helpers), run_callback)
 
 
 def pad(sequence, length, padding = None):
@@ -364,20 +936,50 @@ def log(message, buffer = 'NULL'):
 	weechat.prnt(buffer, 'autosort: {0}'.format(message))
 
 def debug(message, buffer = 'NULL'):
-	if config.debug_log:
+	if config is not None and config.debug_log:
 		weechat.prnt(buffer, 'autosort: debug: {0}'.format(message))
 
-def get_buffers():
-	''' Get a list of all the buffers in weechat. '''
+class BufferInfo(object):
+	'''
+	A snapshot of the properties of a buffer that sorting needs.
+
+	The number is always read. The other properties are only read if `load()` is called,
+	which is only needed for buffers that still need their rules evaluated.
+	'''
+	__slots__ = ('pointer', 'number', 'full_name', 'name', 'short_name', 'localvars')
+
+	def __init__(self, pointer, number):
+		self.pointer    = pointer
+		self.number     = number
+		self.full_name  = None
+		self.name       = None
+		self.short_name = None
+		self.localvars  = None
+
+	def load(self, hdata):
+		''' Read the properties that compiled rules can use. '''
+		self.full_name  = weechat.hdata_string(hdata, self.pointer, 'full_name')
+		self.name       = weechat.hdata_string(hdata, self.pointer, 'name')
+		self.short_name = weechat.hdata_string(hdata, self.pointer, 'short_name')
+		self.localvars  = weechat.hdata_hashtable(hdata, self.pointer, 'local_variables')
+
+def get_buffers(loaded = None):
+	'''
+	Get a list of BufferInfo for all the buffers in weechat, in a single pass over the buffer list.
+
+	The properties are loaded for all buffers,
+	except for buffers in `loaded`, a container of buffer pointers that already have a cached sort key.
+	'''
 	hdata  = weechat.hdata_get('buffer')
 	buffer = weechat.hdata_get_list(hdata, "gui_buffers");
 
 	result = []
 	while buffer:
-		number = weechat.hdata_integer(hdata, buffer, 'number')
-		result.append((number, buffer))
+		info = BufferInfo(buffer, weechat.hdata_integer(hdata, buffer, 'number'))
+		if loaded is None or buffer not in loaded: info.load(hdata)
+		result.append(info)
 		buffer = weechat.hdata_pointer(hdata, buffer, 'next_buffer')
-	return hdata, result
+	return result
 
 class MergedBuffers(list):
 	""" A list of merged buffers, possibly of size 1. """
@@ -385,6 +987,10 @@ class MergedBuffers(list):
 		super(MergedBuffers, self).__init__()
 		self.number = number
 
+	def pointers(self):
+		''' Get a tuple of the pointers of the merged buffers. '''
+		return tuple(buffer.pointer for buffer in self)
+
 def merge_buffer_list(buffers):
 	'''
 	Group merged buffers together.
@@ -392,47 +998,524 @@ def merge_buffer_list(buffers):
 	'''
 	if not buffers: return []
 	result = {}
-	for number, buffer in buffers:
-		if number not in result: result[number] = MergedBuffers(number)
-		result[number].append(buffer)
-	return result.values()
+	for buffer in buffers:
+		if buffer.number not in result: result[buffer.number] = MergedBuffers(buffer.number)
+		result[buffer.number].append(buffer)
+	return list(result.values())
 
-def sort_buffers(hdata, buffers, rules, helpers, case_sensitive):
-	for merged in buffers:
-		for buffer in merged:
-			name = weechat.hdata_string(hdata, buffer, 'name')
+def key_buffers(buffers, config, cache = None):
+	'''
+	Create a GroupKey for each of a list of MergedBuffers.
+	The output is a list of (key, merged) tuples, in the current order of the buffer list.
+	'''
+	evaluator = KeyEvaluator(config, cache)
+	buffers   = sorted(buffers, key=lambda merged: merged.number)
+	return [(evaluator.group_key(merged), merged) for merged in buffers]
+
+def partition_buffers(buffers, prefix):
+	'''
+	Split a list of (key, merged) tuples in blocks of buffers with the same results for the first `prefix` rules.
+	Returns None if the blocks are not contiguous and in order, since then the whole list needs sorting.
+	'''
+	if prefix <= 0 or not buffers: return [buffers]
+	blocks = [[buffers[0]]]
+	for previous, current in zip(buffers, buffers[1:]):
+		order = compare_keys(previous[0], current[0], prefix)
+		if order > 0: return None
+		if order < 0: blocks.append([])
+		blocks[-1].append(current)
+	return blocks
+
+def is_sorted(buffers, rule_count):
+	'''
+	Check if a list of (key, merged) tuples is already sorted.
+	Only adjacent buffers are compared, evaluating only as many rules as needed to tell them apart.
+	'''
+	for i in range(1, len(buffers)):
+		if compare_keys(buffers[i - 1][0], buffers[i][0], rule_count) > 0: return False
+	return True
+
+def sort_level(buffers, level, rule_count):
+	'''
+	Stable sort a list of (key, merged) tuples, starting at the given rule.
 
-	return sorted(buffers, key=merged_sort_key(rules, helpers, case_sensitive))
+	The list is sorted on the result of one rule and split in groups of tied buffers.
+	Only groups with more than one buffer are sorted further on the next rule,
+	so later rules are evaluated only for buffers where they make a difference.
+	'''
+	if len(buffers) < 2 or level >= rule_count: return buffers
 
-def buffer_sort_key(rules, helpers, case_sensitive):
-	''' Create a sort key function for a list of lists of merged buffers. '''
-	def key(buffer):
-		extra_vars = {}
-		for helper_name, helper in sorted(helpers.items()):
-			expanded = weechat.string_eval_expression(helper, {"buffer": buffer}, {}, {})
-			extra_vars[helper_name] = expanded if case_sensitive else casefold(expanded)
-		result = []
+	buffers = sorted(buffers, key=lambda x: x[0].value(level))
+	result  = []
+	for value, tied in itertools.groupby(buffers, key=lambda x: x[0].value(level)):
+		result.extend(sort_level(list(tied), level + 1, rule_count))
+	return result
+
+def compare_keys(a, b, rule_count):
+	''' Compare two lazily evaluated keys, evaluating only as many rules as needed. '''
+	x, y = a.complete_values(), b.complete_values()
+	if x is not None and y is not None:
+		x, y = x[:rule_count], y[:rule_count]
+		return (x > y) - (x < y)
+
+	for level in range(rule_count):
+		x, y = a.value(level), b.value(level)
+		if x != y: return -1 if x < y else 1
+	return 0
+
+class SortKey:
+	'''
+	The sort key of a single buffer, evaluated lazily one rule at a time.
+	The BufferInfo of the buffer is kept to evaluate more rules later.
+
+	The results are interned, since many buffers share values like a server or plugin name.
+	Once all rules are evaluated, the values are stored as a tuple.
+	'''
+	def __init__(self, buffer):
+		self.buffer  = buffer
+		self.helpers = {}
+		self.values  = []
+
+class GroupKey:
+	'''
+	The sort key of a group of merged buffers.
+
+	This is the smallest key of the merged buffers.
+	It is evaluated lazily one rule at a time,
+	keeping track of which buffers can still have the smallest key.
+	'''
+	def __init__(self, evaluator, keys):
+		self.evaluator  = evaluator
+		self.candidates = keys
+		self.values     = []
+
+	def value(self, level):
+		if len(self.candidates) == 1:
+			return self.evaluator.value(self.candidates[0], level)
+		while len(self.values) <= level:
+			i    = len(self.values)
+			best = min(self.evaluator.value(key, i) for key in self.candidates)
+			self.candidates = [key for key in self.candidates if key.values[i] == best]
+			self.values.append(best)
+		if len(self.values) == len(self.evaluator.rules): self.values = tuple(self.values)
+		return self.values[level]
+
+	def complete_values(self):
+		''' Get the tuple of all rule results if they are all evaluated already, or None otherwise. '''
+		# Once only one candidate is left, its values are the values of the group.
+		values = self.candidates[0].values if len(self.candidates) == 1 else self.values
+		return values if isinstance(values, tuple) else None
+
+class KeyEvaluator:
+	'''
+	Evaluates the sort rules for buffers.
+
+	Rules are only evaluated when they are needed for a comparison,
+	and helpers only when they are needed for a rule.
+	The results are remembered in a SortKey for each buffer.
+	If a cache is given, the SortKeys are looked up in and added to the cache, indexed by buffer pointer.
+	Buffers without a cached SortKey must have their BufferInfo loaded.
+
+	Results of rules and helpers are also remembered by the values of their inputs,
+	so a helper that only reads ${server} is evaluated once per server rather than once per buffer.
+	'''
+	def __init__(self, config, cache = None):
+		self.rules          = config.compiled_rules
+		self.helpers        = config.compiled_helpers
+		self.graph          = config.helper_graph
+		self.case_sensitive = config.case_sensitive
+		self.cache          = cache
+		self.memo           = {}
+
+	def sort_key(self, buffer):
+		''' Get the SortKey for a BufferInfo. '''
+		key = self.cache.get(buffer.pointer) if self.cache is not None else None
+		if key is None:
+			key = SortKey(buffer)
+			# Only keys for the cache count, not those of /autosort debug or profile.
+			if self.cache is not None:
+				self.cache[buffer.pointer] = key
+				stats.count('buffers_keyed')
+		return key
+
+	def group_key(self, merged):
+		''' Get the GroupKey for a list of merged BufferInfo. '''
+		return GroupKey(self, [self.sort_key(buffer) for buffer in merged])
+
+	def value(self, key, level):
+		''' Get the result of one rule for a SortKey, evaluating rules up to the requested one if needed. '''
+		values = key.values
+		while len(values) <= level:
+			values.append(self.evaluate_rule(key, len(values)))
+
+		# Once all rules are evaluated, the helpers aren't needed anymore.
+		if key.helpers is not None and len(values) == len(self.rules):
+			key.helpers = None
+			key.values  = tuple(values)
+		return values[level]
+
+	def refresh(self, key, rules):
+		'''
+		Evaluate some rules again for a SortKey whose BufferInfo was replaced.
+		Rules that weren't evaluated before are left for later.
+		Returns True if any of the results changed.
+		'''
+		values      = list(key.values)
+		key.helpers = {}
+		changed     = False
 		for rule in rules:
-			expanded = weechat.string_eval_expression(rule, {"buffer": buffer}, extra_vars, {})
-			result.append(expanded if case_sensitive else casefold(expanded))
+			if rule >= len(values): continue
+			value = self.evaluate_rule(key, rule)
+			if value != values[rule]:
+				values[rule] = value
+				changed      = True
+
+		if len(values) == len(self.rules):
+			key.helpers = None
+			key.values  = tuple(values)
+		else:
+			key.values  = values
+		return changed
+
+	def evaluate_rule(self, key, rule):
+		''' Evaluate a rule for a SortKey, evaluating the helpers it needs first. '''
+		for name in self.graph.rule_helpers[rule]:
+			if name not in key.helpers: key.helpers[name] = self.evaluate_helper(key, name)
+		return self.evaluate(self.rules[rule], rule, key.buffer, key.helpers)
+
+	def evaluate_helper(self, key, name):
+		''' Evaluate a helper for a SortKey. The helpers it depends on must already be evaluated. '''
+		extra_vars = dict((dependency, key.helpers[dependency]) for dependency in self.graph.dependencies[name])
+		return self.evaluate(self.helpers[name], name, key.buffer, extra_vars)
+
+	def evaluate(self, expression, name, buffer, extra_vars):
+		'''
+		Evaluate a rule or helper, reusing the result for an earlier buffer with the same inputs.
+		The name is the rule index or helper name.
+		'''
+		memo_key = None
+		if expression.memo_inputs is not None:
+			memo_key = (name,) + tuple(read_input(buffer, extra_vars, input) for input in expression.memo_inputs)
+			result   = self.memo.get(memo_key)
+			if result is not None: return result
+
+		result = expression.evaluate(buffer, extra_vars)
+		result = intern_string(result if self.case_sensitive else casefold(result))
+		if memo_key is not None: self.memo[memo_key] = result
 		return result
 
-	return key
+def buffer_sort_key(config, cache = None):
+	'''
+	Create a sort key function for a BufferInfo.
+	The key function evaluates all rules and returns the list of results.
+	'''
+	evaluator = KeyEvaluator(config, cache)
+	def key(buffer):
+		key = evaluator.sort_key(buffer)
+		if config.rules: evaluator.value(key, len(config.rules) - 1)
+		return key.values
 
-def merged_sort_key(rules, helpers, case_sensitive):
-	buffer_key = buffer_sort_key(rules, helpers, case_sensitive)
-	def key(merged):
-		best = None
-		for buffer in merged:
-			this = buffer_key(buffer)
-			if best is None or this < best: best = this
-		return best
 	return key
 
-def apply_buffer_order(buffers):
-	''' Sort the buffers in weechat according to the given order. '''
+def longest_increasing_subsequence(values):
+	''' Get the indices of a longest strictly increasing subsequence of a list. '''
+	tails   = []
+	indices = []
+	parents = [None] * len(values)
+	for i, value in enumerate(values):
+		j = bisect.bisect_left(tails, value)
+		if j > 0: parents[i] = indices[j - 1]
+		if j == len(tails):
+			tails.append(value)
+			indices.append(i)
+		else:
+			tails[j]   = value
+			indices[j] = i
+
+	result = []
+	i = indices[-1] if indices else None
+	while i is not None:
+		result.append(i)
+		i = parents[i]
+	result.reverse()
+	return result
+
+def apply_buffer_order(buffers, first = 1):
+	'''
+	Sort the buffers in weechat according to the given order.
+
+	The buffers must be MergedBuffers holding their current number,
+	normally numbered from `first` up without gaps. They are only moved within those numbers.
+	The longest run of buffers that is already in the right relative order stays in place,
+	only the other buffers are moved. If nothing is out of order, no buffer is moved at all.
+
+	Returns the number of moved buffers.
+	'''
+	numbers = [merged.number for merged in buffers]
+
+	# Without a contiguous numbering we can't predict the effect of a move, so renumber everything.
+	if sorted(numbers) != list(range(first, first + len(numbers))):
+		for i, buffer in enumerate(buffers):
+			weechat.buffer_set(buffer[0].pointer, "number", str(first + i))
+		stats.count('buffer_set', len(buffers))
+		return len(buffers)
+
+	keep    = set(longest_increasing_subsequence(numbers))
+	current = sorted(range(len(buffers)), key=lambda i: numbers[i])
+
+	# Move each buffer directly behind its predecessor in the new order.
+	# The buffers that stay are already in the right relative order, so this sorts the list.
+	moved = 0
 	for i, buffer in enumerate(buffers):
-		weechat.buffer_set(buffer[0], "number", str(i + 1))
+		if i in keep: continue
+		current.remove(i)
+		position = current.index(i - 1) + 1 if i > 0 else 0
+		current.insert(position, i)
+		weechat.buffer_set(buffer[0].pointer, "number", str(first + position))
+		moved += 1
+	stats.count('buffer_set', moved)
+	return moved
+
+class BufferOrder:
+	''' The order of the buffer list as last applied by autosort. '''
+	def __init__(self, keys, groups):
+		self.keys    = keys
+		self.groups  = groups
+		self.buffers = set(buffer for group in groups for buffer in group)
+
+def insert_buffers(new_buffers):
+	'''
+	Move newly opened buffers into place in the last applied buffer order.
+
+	Only the keys of the new buffers are computed.
+	Each buffer is placed with a binary search and moved with a single buffer_set.
+
+	Returns False if the current buffer list doesn't match the last applied order,
+	in which case nothing is moved and a full sort is needed.
+	'''
+	if buffer_order is None: return False
+
+	buffers = sorted(merge_buffer_list(get_buffers(key_cache)), key=lambda merged: merged.number)
+	if [merged.number for merged in buffers] != list(range(1, len(buffers) + 1)):
+		return False
+
+	new_buffers = set(new_buffers)
+	current     = {}
+	known       = []
+	inserted    = []
+	for merged in buffers:
+		group = merged.pointers()
+		current[group] = merged
+		if not new_buffers.intersection(group):
+			known.append(group)
+		elif len(group) == 1:
+			inserted.append(group)
+		else:
+			return False
+
+	if known != buffer_order.groups: return False
+
+	evaluator  = KeyEvaluator(config, key_cache)
+	rule_count = len(config.rules)
+	keys       = list(buffer_order.keys)
+	groups     = list(buffer_order.groups)
+	for group in inserted:
+		this = evaluator.group_key(current[group])
+
+		# Binary search for the position after all buffers that sort lower or equal.
+		low, high = 0, len(keys)
+		while low < high:
+			middle = (low + high) // 2
+			if compare_keys(this, keys[middle], rule_count) < 0:
+				high = middle
+			else:
+				low = middle + 1
+
+		keys.insert(low, this)
+		groups.insert(low, group)
+
+	# The known buffers are already in order, so only the new buffers will be moved.
+	apply_buffer_order([current[group] for group in groups])
+	set_buffer_order(keys, groups)
+	return True
+
+def set_buffer_order(keys, groups):
+	''' Remember the last applied buffer order. '''
+	global buffer_order
+	buffer_order = BufferOrder(keys, groups) if groups is not None else None
+	if groups is not None and config.remember_order:
+		remember_order(groups)
+
+def merge_order(remembered, current):
+	'''
+	Merge the current order of the open buffers into a remembered order of full names.
+	Remembered buffers that aren't open stay directly after the open buffer they followed before,
+	or at the start if no open buffer came before them.
+	'''
+	current_set = set(current)
+	after       = {}
+	anchor      = None
+	for name in remembered:
+		if name in current_set:
+			anchor = name
+		else:
+			after.setdefault(anchor, []).append(name)
+
+	result = after.pop(None, [])
+	for name in current:
+		result.append(name)
+		result.extend(after.pop(name, []))
+	return result
+
+class OrderMemory:
+	'''
+	The last sorted order of the buffers by full name, kept in a file across restarts.
+
+	Buffers that were seen before are moved to their remembered position as soon as they are opened,
+	instead of piling up at the end of the buffer list until the next sort.
+	The next sort checks the prediction and only has to move the buffers that were predicted wrong.
+
+	The day each name was last open is remembered too,
+	so buffers that weren't open for `forget_after` days are forgotten.
+	'''
+	# Days after which a buffer that isn't open is forgotten.
+	forget_after = 30
+	# Milliseconds to wait before writing a changed order to the file.
+	save_delay   = 60000
+
+	def __init__(self, path):
+		self.path     = path
+		self.names    = []
+		self.ranks    = {}
+		self.seen     = {}
+		self.dirty    = False
+		# The full names, ranks and pointers of the open buffers in sorted order.
+		self.current  = []
+		self.live     = []
+		self.pointers = []
+
+	def load(self, day):
+		'''
+		Read the remembered order from the file, if it exists.
+		Names from files without the days they were last seen count as seen on `day`.
+		'''
+		if not os.path.exists(self.path): return
+		try:
+			with open(self.path) as file:
+				data = json.load(file)
+		except (IOError, OSError, ValueError) as e:
+			log('Failed to read remembered buffer order from {0}: {1}'.format(self.path, e))
+			return
+		if isinstance(data, list):
+			data = {'names': data, 'seen': [day] * len(data)}
+		names = data.get('names') if isinstance(data, dict) else None
+		seen  = data.get('seen')  if isinstance(data, dict) else None
+		if not isinstance(names, list) or not all(isinstance(name, (str, unicode)) for name in names) \
+				or not isinstance(seen, list) or len(seen) != len(names) or not all(isinstance(x, int) for x in seen):
+			log('Ignoring invalid remembered buffer order in {0}.'.format(self.path))
+			return
+		# Python 2 gives unicode strings, but buffer names are byte strings.
+		names = [name if isinstance(name, str) else name.encode('utf-8') for name in names]
+		self.set_names(names)
+		self.seen = dict(zip(names, seen))
+
+	def save(self):
+		''' Write the remembered order to the file if it changed. '''
+		if not self.dirty: return
+		try:
+			with open(self.path + '.tmp', 'w') as file:
+				json.dump({'names': self.names, 'seen': [self.seen[name] for name in self.names]}, file, separators=(',', ':'))
+			os.rename(self.path + '.tmp', self.path)
+		except (IOError, OSError) as e:
+			log('Failed to write remembered buffer order to {0}: {1}'.format(self.path, e))
+			return
+		self.dirty = False
+
+	def set_names(self, names):
+		self.names = names
+		self.ranks = dict((name, rank) for rank, name in enumerate(names))
+
+	def remember(self, names, pointers, day):
+		'''
+		Remember the sorted order of the open buffers, given by their full names and pointers,
+		and forget buffers that weren't open for `forget_after` days.
+		The file isn't written, that is left to the caller.
+		'''
+		if pointers == self.pointers and names == self.current: return
+		for name in names:
+			if self.seen.get(name) != day:
+				self.seen[name] = day
+				self.dirty      = True
+		merged = merge_order(self.names, names)
+		if len(self.seen) > len(names):
+			merged = [name for name in merged if day - self.seen[name] < self.forget_after]
+			self.seen = dict((name, self.seen[name]) for name in merged)
+		if merged != self.names:
+			self.set_names(merged)
+			self.dirty = True
+		self.current  = names
+		self.live     = [self.ranks[name] for name in names]
+		self.pointers = list(pointers)
+
+	def place(self, name, pointer):
+		'''
+		Predict the position of a newly opened buffer.
+		Returns the pointer of the open buffer it should be placed before, or None if it should stay where it is.
+		'''
+		rank = self.ranks.get(name)
+		if rank is None: return None
+		i = bisect.bisect_right(self.live, rank)
+		self.live.insert(i, rank)
+		self.pointers.insert(i, pointer)
+		return self.pointers[i + 1] if i + 1 < len(self.pointers) else None
+
+	def forget(self, pointer):
+		''' Forget the position of a closed buffer. '''
+		if pointer in self.pointers:
+			i = self.pointers.index(pointer)
+			del self.live[i]
+			del self.pointers[i]
+
+def remember_order(groups):
+	''' Remember the full names of the buffers in the applied order. '''
+	names    = []
+	pointers = []
+	for group in groups:
+		for pointer in group:
+			key = key_cache.get(pointer)
+			if key is None or key.buffer.full_name is None: continue
+			names.append(key.buffer.full_name)
+			pointers.append(pointer)
+	order_memory.remember(names, pointers, today())
+	if order_memory.dirty: schedule_order_save()
+
+def today():
+	''' Get the current day as a number of days since the epoch. '''
+	return int(time.time() // 86400)
+
+def schedule_order_save():
+	''' Write the remembered order to its file a while from now, if no write is scheduled yet. '''
+	global order_save_timer
+	if order_save_timer is None:
+		order_save_timer = weechat.hook_timer(OrderMemory.save_delay, 0, 1, 'on_order_save_timer', '')
+
+def on_order_save_timer(data, remaining_calls):
+	''' Write the remembered order to its file. '''
+	global order_save_timer
+	order_save_timer = None
+	order_memory.save()
+	return weechat.WEECHAT_RC_OK
+
+def place_buffer(pointer):
+	''' Move a newly opened buffer to the position predicted by the remembered order. '''
+	hdata  = weechat.hdata_get('buffer')
+	before = order_memory.place(weechat.hdata_string(hdata, pointer, 'full_name'), pointer)
+	if before is None: return
+	number = weechat.hdata_integer(hdata, before, 'number')
+	if number < weechat.hdata_integer(hdata, pointer, 'number'):
+		weechat.buffer_set(pointer, 'number', str(number))
+		stats.count('buffer_set')
+		stats.count('buffers_placed')
 
 def split_args(args, expected, optional = 0):
 	''' Split an argument string in the desired number of arguments. '''
@@ -441,38 +1524,255 @@ def split_args(args, expected, optional = 0):
 		raise HumanReadableError('Expected at least {0} arguments, got {1}.'.format(expected, len(split)))
 	return split[:-1] + pad(split[-1].split(' ', optional), optional + 1, '')
 
+def sort_and_apply(buffers):
+	'''
+	Sort a list of MergedBuffers and apply the new order.
+
+	If the partitions given by the first rules are in order, only the partitions that aren't sorted are sorted,
+	each in place. If the buffers are already sorted, nothing is sorted or moved.
+	Returns the number of moved buffers.
+	'''
+	rule_count = len(config.rules)
+	buffers    = key_buffers(buffers, config, key_cache)
+	prefix     = min(config.partition_rules, rule_count)
+	blocks     = None
+
+	# Partitions can only be moved in place if the numbering has no gaps.
+	if [merged.number for key, merged in buffers] == list(range(1, len(buffers) + 1)):
+		blocks = partition_buffers(buffers, prefix)
+	if blocks is None:
+		blocks = [buffers]
+		prefix = 0
+
+	result = []
+	moved  = 0
+	sorted_blocks = 0
+	for block in blocks:
+		if not is_sorted(block, rule_count):
+			first = block[0][1].number
+			block = sort_level(block, prefix, rule_count)
+			moved += apply_buffer_order([merged for key, merged in block], first)
+			sorted_blocks += 1
+		result.extend(block)
+	set_buffer_order([key for key, merged in result], [merged.pointers() for key, merged in result])
+
+	if sorted_blocks: stats.count('sorts_performed')
+	else:             stats.count('sorts_skipped')
+	if prefix > 0: debug('Sorted {0} of {1} partition(s).'.format(sorted_blocks, len(blocks)))
+
+	debug('Skipped {0} sort(s) because the buffers were already sorted, performed {1} sort(s).'.format(stats.counters['sorts_skipped'], stats.counters['sorts_performed']))
+	return moved
+
 def do_sort(verbose = False):
 	start = perf_counter()
 
-	hdata, buffers = get_buffers()
-	buffers = merge_buffer_list(buffers)
-	buffers = sort_buffers(hdata, buffers, config.rules, config.helpers, config.case_sensitive)
-	apply_buffer_order(buffers)
+	moved = sort_and_apply(merge_buffer_list(get_buffers()))
 
 	elapsed = perf_counter() - start
+	stats.sort_duration.add(elapsed * 1000)
 	if verbose:
-		log("Finished sorting buffers in {0:.4f} seconds.".format(elapsed))
+		log("Finished sorting buffers in {0:.4f} seconds, moved {1} buffer(s).".format(elapsed, moved))
+	else:
+		debug("Finished sorting buffers in {0:.4f} seconds, moved {1} buffer(s).".format(elapsed, moved))
+
+class SortJob:
+	'''
+	A full sort that evaluates the sort keys in time slices, so sorting a huge buffer list doesn't block weechat.
+
+	Each call to run() evaluates keys until the time budget is used up.
+	Once all keys are evaluated, the buffers are sorted and the new order is applied in one go.
+	If anything that affects the sort changed in between, the job starts over with a fresh buffer list.
+	Keys that are still valid stay in the key cache, so starting over doesn't lose finished work.
+	'''
+	def __init__(self, budget):
+		self.budget   = budget
+		self.elapsed  = 0.0
+		self.slices   = 0
+		self.restarts = 0
+		self.restart()
+
+	def restart(self):
+		''' Take a fresh snapshot of the buffer list. '''
+		global pending_buffers
+		global pending_full_sort
+
+		# This sort includes all changes up to now, so nothing is left to do for earlier signals.
+		pending_buffers   = []
+		pending_full_sort = False
+
+		self.generation = sort_generation
+		self.buffers    = merge_buffer_list(get_buffers(key_cache))
+		self.evaluator  = KeyEvaluator(config, key_cache)
+		self.pending    = [buffer for merged in self.buffers for buffer in merged]
+		self.position   = 0
+
+	def refresh_numbers(self):
+		'''
+		Update the snapshot with the current buffer numbers, read in a single pass over the buffer list.
+		Returns False if buffers were opened, closed, merged or unmerged since the snapshot.
+		'''
+		hdata   = weechat.hdata_get('buffer')
+		buffer  = weechat.hdata_get_list(hdata, 'gui_buffers')
+		numbers = {}
+		while buffer:
+			numbers[buffer] = weechat.hdata_integer(hdata, buffer, 'number')
+			buffer = weechat.hdata_pointer(hdata, buffer, 'next_buffer')
+
+		if len(numbers) != len(self.pending): return False
+		taken = set()
+		for merged in self.buffers:
+			current = set(numbers.get(buffer.pointer) for buffer in merged)
+			if len(current) != 1 or None in current: return False
+			number = current.pop()
+			if number in taken: return False
+			taken.add(number)
+			merged.number = number
+			for buffer in merged: buffer.number = number
+		return True
+
+	def run(self):
+		''' Run one time slice. Returns True if the job is finished. '''
+		start = perf_counter()
+		self.slices += 1
+		if self.generation != sort_generation:
+			debug('Buffers changed while sorting, starting over.')
+			self.restarts += 1
+			self.restart()
+			scheduler.sort_restarted()
+
+		deadline = start + self.budget / 1000.0
+		last     = len(config.rules) - 1
+		# Always evaluate at least one buffer, so every time slice makes progress.
+		while self.position < len(self.pending):
+			if last >= 0: self.evaluator.value(self.evaluator.sort_key(self.pending[self.position]), last)
+			self.position += 1
+			if perf_counter() >= deadline: break
+
+		if self.position < len(self.pending):
+			self.elapsed += perf_counter() - start
+			return False
+
+		# Moves between time slices don't always change the sort generation, but the moves are computed from the numbers.
+		if not self.refresh_numbers():
+			debug('Buffers moved while sorting, starting over.')
+			self.restarts += 1
+			self.restart()
+			scheduler.sort_restarted()
+			self.elapsed += perf_counter() - start
+			return False
+
+		moved = sort_and_apply(self.buffers)
+
+		self.elapsed += perf_counter() - start
+		stats.sort_duration.add(self.elapsed * 1000)
+		debug('Finished sorting buffers in {0:.4f} seconds over {1} time slice(s) with {2} restart(s), moved {3} buffer(s).'.format(self.elapsed, self.slices, self.restarts, moved))
+		return True
+
+def start_sort_job():
+	'''
+	Start a full sort in time slices.
+	Returns True if the sort finished in the first time slice, otherwise the rest runs from a timer.
+	'''
+	global sort_job
+	job = SortJob(config.time_slice)
+	if job.run(): return True
+	sort_job = job
+	weechat.hook_timer(1, 0, 1, 'on_sort_job_timer', '')
+	return False
+
+def on_sort_job_timer(data, remaining_calls):
+	''' Run the next time slice of the sort in progress. '''
+	global sort_job
+	job = sort_job
+	if job is None: return weechat.WEECHAT_RC_OK
+
+	if job.run():
+		sort_job = None
+		scheduler.sort_finished(job.elapsed * 1000)
 	else:
-		debug("Finished sorting buffers in {0:.4f} seconds.".format(elapsed))
+		weechat.hook_timer(1, 0, 1, 'on_sort_job_timer', '')
+	return weechat.WEECHAT_RC_OK
+
+def invalidate_sort_job():
+	''' Make a time sliced sort in progress start over with a fresh buffer list. '''
+	global sort_generation
+	sort_generation += 1
+
+def do_queued_sort():
+	'''
+	Sort the buffers in response to the signals received since the last sort.
+
+	If only buffer_opened signals were received, the new buffers are inserted in the last applied order.
+	Otherwise, or if the buffer list changed behind our back, a full sort is done.
+	If a time slice is configured, the full sort may continue after this function returns,
+	in which case False is returned.
+	'''
+	global pending_buffers
+	global pending_full_sort
+
+	new_buffers, full_sort = pending_buffers, pending_full_sort
+	pending_buffers   = []
+	pending_full_sort = False
+
+	if not full_sort and new_buffers:
+		start = perf_counter()
+		if insert_buffers(new_buffers):
+			elapsed = perf_counter() - start
+			stats.count('inserts')
+			stats.insert_duration.add(elapsed * 1000)
+			debug('Inserted {0} new buffer(s) in {1:.4f} seconds.'.format(len(new_buffers), elapsed))
+			return
+		debug('Buffer list does not match the last sorted order, falling back to a full sort.')
+
+	if config.time_slice > 0:
+		return start_sort_job()
+	do_sort()
 
 def command_sort(buffer, command, args):
 	''' Sort the buffers and print a confirmation. '''
+	# Re-evaluate everything, in case rules depend on something that doesn't invalidate the cache.
+	key_cache.clear()
+	invalidate_sort_job()
 	do_sort(True)
 	return weechat.WEECHAT_RC_OK
 
+def describe_expression(expression):
+	if expression.compiled: return 'compiled: {0}'.format(expression.expression)
+	return 'evaluated by weechat ({0}): {1}'.format(expression.error, expression.expression)
+
+def describe_inputs(inputs):
+	if inputs is None: return 'anything'
+	if not inputs: return 'nothing'
+	return ', '.join('${{{0}}}'.format(name if kind == 'localvar' else kind + '.' + name) for kind, name in sorted(inputs))
+
 def command_debug(buffer, command, args):
-	hdata, buffers = get_buffers()
-	buffers = merge_buffer_list(buffers)
+	buffers = merge_buffer_list(get_buffers())
+
+	# Show which rules and helpers are compiled.
+	log('Compiled rules and helpers:')
+	for i, rule in enumerate(config.compiled_rules):
+		log('    rule {0}: {1}'.format(i, describe_expression(rule)))
+		log('        reads: {0}'.format(describe_inputs(config.rule_inputs[i])))
+	for name, helper in sorted(config.compiled_helpers.items()):
+		log('    helper {0}: {1}'.format(name, describe_expression(helper)))
+
+	# Show the delays currently used for automatic sorting.
+	log('Scheduler state: {0}'.format(scheduler.state))
+	log('    signal_delay: {0} ms (configured {1} ms)'.format(scheduler.effective_signal_delay(), config.signal_delay))
+	log('    sort_limit: {0} ms (configured {1} ms)'.format(scheduler.effective_sort_limit(), config.sort_limit))
+	if scheduler.sort_duration is not None:
+		log('    average sort duration: {0:.2f} ms'.format(scheduler.sort_duration))
+	if scheduler.signal_interval is not None:
+		log('    average time between signals: {0:.2f} ms'.format(scheduler.signal_interval))
 
 	# Show evaluation results.
 	log('Individual evaluation results:')
 	start = perf_counter()
-	key = buffer_sort_key(config.rules, config.helpers, config.case_sensitive)
+	key = buffer_sort_key(config)
 	results = []
 	for merged in buffers:
 		for buffer in merged:
-			fullname = weechat.hdata_string(hdata, buffer, 'full_name')
-			results.append((fullname, key(buffer)))
+			results.append((buffer.full_name, key(buffer)))
 	elapsed = perf_counter() - start
 
 	for fullname, result in results:
@@ -483,6 +1783,161 @@ def command_debug(buffer, command, args):
 
 	return weechat.WEECHAT_RC_OK
 
+def command_hooks(buffer, command, args):
+	''' Show the signals autosort is hooked to. '''
+	output = 'Signals that trigger a sort:\n'
+	for signal in sorted(hooks):
+		output += '    {0} (hook {1})\n'.format(signal, hooks[signal])
+	output += 'Signals that update cached sort keys: {0}\n'.format(', '.join(invalidating_signals))
+	output += 'Signals that start suspending sorting: {0}\n'.format(', '.join(burst_start_signals))
+	output += 'Signals that end suspending sorting: {0}\n'.format(', '.join(burst_end_signals))
+	log(output)
+	return weechat.WEECHAT_RC_OK
+
+class ProfiledKeyEvaluator(KeyEvaluator):
+	'''
+	A KeyEvaluator that records how long each rule and helper takes.
+
+	The time of a rule or helper includes looking up memoized results and normalizing the result.
+	The total time spent evaluating rules also includes getting their helpers ready.
+	Keys are not cached and not counted in the statistics.
+	'''
+	def __init__(self, config, rules, helpers):
+		KeyEvaluator.__init__(self, config)
+		self.rule_samples   = rules
+		self.helper_samples = helpers
+		self.elapsed        = 0.0
+
+	def evaluate_rule(self, key, rule):
+		start  = perf_counter()
+		result = KeyEvaluator.evaluate_rule(self, key, rule)
+		self.elapsed += perf_counter() - start
+		return result
+
+	def evaluate(self, expression, name, buffer, extra_vars):
+		start  = perf_counter()
+		result = KeyEvaluator.evaluate(self, expression, name, buffer, extra_vars)
+		# Rules are named by their index, helpers by their name.
+		samples = self.rule_samples[name] if isinstance(name, int) else self.helper_samples[name]
+		samples.append(perf_counter() - start)
+		return result
+
+def percentile(samples, fraction):
+	''' Get a percentile of a sorted list of samples. '''
+	if not samples: return 0.0
+	return samples[max(0, int(math.ceil(fraction * len(samples))) - 1)]
+
+def command_profile(buffer, command, args):
+	''' Sort the buffers a number of times without cache, timing each rule, helper and phase. '''
+	runs = parse_int(args, 'runs') if args.strip() else 1
+	if runs < 1: raise HumanReadableError('Invalid runs: expected a positive integer, got {0}.'.format(runs))
+
+	rule_count = len(config.rules)
+	rules      = [[] for rule in config.rules]
+	helpers    = dict((name, []) for name in config.helpers)
+	phases     = collections.OrderedDict((name, 0.0) for name in ('get_buffers', 'key evaluation', 'sorted()', 'apply_buffer_order'))
+
+	# Moves made by the profile are not counted in the statistics.
+	buffer_set   = stats.counters['buffer_set']
+	start_groups = None
+	for run in range(runs):
+		if start_groups is not None:
+			# Put the buffers back in their starting order, so every run has the same buffers to move.
+			current = dict((merged.pointers(), merged) for merged in merge_buffer_list(get_buffers()))
+			apply_buffer_order([current[group] for group in start_groups if group in current])
+
+		start   = perf_counter()
+		buffers = merge_buffer_list(get_buffers())
+		phases['get_buffers'] += perf_counter() - start
+		if start_groups is None:
+			start_groups = [merged.pointers() for merged in sorted(buffers, key=lambda merged: merged.number)]
+
+		# Everything but evaluating the rules counts as sorting.
+		start     = perf_counter()
+		evaluator = ProfiledKeyEvaluator(config, rules, helpers)
+		keyed     = [(evaluator.group_key(merged), merged) for merged in sorted(buffers, key=lambda merged: merged.number)]
+		keyed     = sort_level(keyed, 0, rule_count)
+		elapsed   = perf_counter() - start
+		phases['key evaluation'] += evaluator.elapsed
+		phases['sorted()']       += elapsed - evaluator.elapsed
+
+		start = perf_counter()
+		apply_buffer_order([merged for key, merged in keyed])
+		phases['apply_buffer_order'] += perf_counter() - start
+
+	stats.counters['buffer_set'] = buffer_set
+	# The profile keys are not cached, so they can't be used as the applied order.
+	set_buffer_order(None, None)
+	# A sort in progress has a snapshot of the buffer numbers from before the profile moved buffers.
+	invalidate_sort_job()
+
+	total = sum(phases.values())
+	def share(seconds):
+		return 100.0 * seconds / total if total > 0 else 0.0
+
+	def describe(samples):
+		samples = sorted(samples)
+		if not samples: return 'not evaluated'
+		spent = sum(samples)
+		return '{0} call(s), total {1:.3f} ms, mean {2:.4f} ms, p95 {3:.4f} ms, {4:.1f}%'.format(
+			len(samples), spent * 1000, spent * 1000 / len(samples), percentile(samples, 0.95) * 1000, share(spent))
+
+	output = 'Profile of {0} sort(s) of {1} buffer(s), {2:.3f} ms in total:\n'.format(runs, sum(len(merged) for merged in buffers), total * 1000)
+	output += 'Phases:\n'
+	for name, spent in phases.items():
+		output += '    {0}: total {1:.3f} ms, mean {2:.3f} ms per sort, {3:.1f}%\n'.format(name, spent * 1000, spent * 1000 / runs, share(spent))
+	if runs > 1:
+		output += '    The starting order was restored before each sort, which is not included in the timings.\n'
+	output += 'Rules:\n'
+	for i, samples in enumerate(rules):
+		output += '    {0}: {1}: {2}\n'.format(i, config.rules[i], describe(samples))
+	output += 'Helpers:\n'
+	for name, samples in sorted(helpers.items()):
+		output += '    {0}: {1}\n'.format(name, describe(samples))
+	log(output)
+
+	return weechat.WEECHAT_RC_OK
+
+def data_path(path):
+	''' Get the absolute path of a file, relative paths are relative to the weechat data directory. '''
+	path = os.path.expanduser(path)
+	if os.path.isabs(path): return path
+	return os.path.join(weechat.info_get('weechat_data_dir', '') or weechat.info_get('weechat_dir', ''), path)
+
+def dump_line(record):
+	return json.dumps(record, separators=(',', ':'), sort_keys=True) + '\n'
+
+def command_dump(buffer, command, args):
+	''' Write the buffer list and the sort configuration to a file as JSON Lines. '''
+	if not args.strip(): raise HumanReadableError('Missing argument: expected a file name.')
+	path    = data_path(args.strip())
+	buffers = get_buffers()
+
+	try:
+		with open(path, 'w') as file:
+			file.write(dump_line({
+				'type':            'config',
+				'version':         SCRIPT_VERSION,
+				'rules':           config.rules,
+				'helpers':         config.helpers,
+				'case_sensitive':  bool(config.case_sensitive),
+				'partition_rules': config.partition_rules,
+			}))
+			for info in buffers:
+				file.write(dump_line({
+					'type':       'buffer',
+					'number':     info.number,
+					'full_name':  info.full_name,
+					'name':       info.name,
+					'short_name': info.short_name,
+					'localvars':  info.localvars,
+				}))
+	except (IOError, OSError) as e:
+		raise HumanReadableError('Failed to write {0}: {1}'.format(path, e))
+
+	log('Wrote {0} buffer(s) to {1}.'.format(len(buffers), path))
+	return weechat.WEECHAT_RC_OK
+
 def command_rule_list(buffer, command, args):
 	''' Show the list of sorting rules. '''
 	output = 'Sorting rules:\n'
@@ -497,8 +1952,9 @@ def command_rule_list(buffer, command, args):
 
 def command_rule_add(buffer, command, args):
 	''' Add a rule to the rule list. '''
-	config.rules.append(args)
-	config.save_rules()
+	rules = list(config.rules)
+	rules.append(args)
+	config.save_rules(rules)
 	command_rule_list(buffer, command, '')
 
 	return weechat.WEECHAT_RC_OK
@@ -509,8 +1965,9 @@ def command_rule_insert(buffer, command, args):
 	index, rule = split_args(args, 2)
 	index = parse_int(index, 'index')
 
-	config.rules.insert(index, rule)
-	config.save_rules()
+	rules = list(config.rules)
+	rules.insert(index, rule)
+	config.save_rules(rules)
 	command_rule_list(buffer, command, '')
 	return weechat.WEECHAT_RC_OK
 
@@ -520,8 +1977,9 @@ def command_rule_update(buffer, command, args):
 	index, rule = split_args(args, 2)
 	index = parse_int(index, 'index')
 
-	config.rules[index] = rule
-	config.save_rules()
+	rules = list(config.rules)
+	rules[index] = rule
+	config.save_rules(rules)
 	command_rule_list(buffer, command, '')
 	return weechat.WEECHAT_RC_OK
 
@@ -531,8 +1989,9 @@ def command_rule_delete(buffer, command, args):
 	index = args.strip()
 	index = parse_int(index, 'index')
 
-	config.rules.pop(index)
-	config.save_rules()
+	rules = list(config.rules)
+	rules.pop(index)
+	config.save_rules(rules)
 	command_rule_list(buffer, command, '')
 	return weechat.WEECHAT_RC_OK
 
@@ -543,8 +2002,9 @@ def command_rule_move(buffer, command, args):
 	index_a = parse_int(index_a, 'index')
 	index_b = parse_int(index_b, 'index')
 
-	list_move(config.rules, index_a, index_b)
-	config.save_rules()
+	rules = list(config.rules)
+	list_move(rules, index_a, index_b)
+	config.save_rules(rules)
 	command_rule_list(buffer, command, '')
 	return weechat.WEECHAT_RC_OK
 
@@ -555,8 +2015,9 @@ def command_rule_swap(buffer, command, args):
 	index_a = parse_int(index_a, 'index')
 	index_b = parse_int(index_b, 'index')
 
-	list_swap(config.rules, index_a, index_b)
-	config.save_rules()
+	rules = list(config.rules)
+	list_swap(rules, index_a, index_b)
+	config.save_rules(rules)
 	command_rule_list(buffer, command, '')
 	return weechat.WEECHAT_RC_OK
 
@@ -580,8 +2041,9 @@ def command_helper_set(buffer, command, args):
 	''' Add/update a helper to the helper list. '''
 	name, expression = split_args(args, 2)
 
-	config.helpers[name] = expression
-	config.save_helpers()
+	helpers = dict(config.helpers)
+	helpers[name] = expression
+	config.save_helpers(helpers)
 	command_helper_list(buffer, command, '')
 
 	return weechat.WEECHAT_RC_OK
@@ -590,8 +2052,9 @@ def command_helper_delete(buffer, command, args):
 	''' Delete a helper from the helper list. '''
 	name = args.strip()
 
-	del config.helpers[name]
-	config.save_helpers()
+	helpers = dict(config.helpers)
+	del helpers[name]
+	config.save_helpers(helpers)
 	command_helper_list(buffer, command, '')
 	return weechat.WEECHAT_RC_OK
 
@@ -600,12 +2063,13 @@ def command_helper_rename(buffer, command, args):
 	''' Rename a helper to a new position. '''
 	old_name, new_name = split_args(args, 2)
 
+	helpers = dict(config.helpers)
 	try:
-		config.helpers[new_name] = config.helpers[old_name]
-		del config.helpers[old_name]
+		helpers[new_name] = helpers[old_name]
+		del helpers[old_name]
 	except KeyError:
 		raise HumanReadableError('No such helper: {0}'.format(old_name))
-	config.save_helpers()
+	config.save_helpers(helpers)
 	command_helper_list(buffer, command, '')
 	return weechat.WEECHAT_RC_OK
 
@@ -613,12 +2077,13 @@ def command_helper_rename(buffer, command, args):
 def command_helper_swap(buffer, command, args):
 	''' Swap two helpers. '''
 	a, b = split_args(args, 2)
+	helpers = dict(config.helpers)
 	try:
-		config.helpers[b], config.helpers[a] = config.helpers[a], config.helpers[b]
+		helpers[b], helpers[a] = helpers[a], helpers[b]
 	except KeyError as e:
 		raise HumanReadableError('No such helper: {0}'.format(e.args[0]))
 
-	config.save_helpers()
+	config.save_helpers(helpers)
 	command_helper_list(buffer, command, '')
 	return weechat.WEECHAT_RC_OK
 
@@ -640,136 +2105,504 @@ def call_command(buffer, command, args, subcommands):
 	log('{0}: command not found'.format(' '.join(command)))
 	return weechat.WEECHAT_RC_ERROR
 
-def on_signal(data, signal, signal_data):
-	global signal_delay_timer
-	global sort_queued
-
-	# If the sort limit timeout is started, we're in the hold-off time after sorting, just queue a sort.
-	if sort_limit_timer is not None:
-		if sort_queued:
-			debug('Signal {0} ignored, sort limit timeout is active and sort is already queued.'.format(signal))
+class SortScheduler:
+	'''
+	Decides when to sort the buffer list in response to signals.
+
+	The scheduler is always in one of these states:
+	  idle:      Nothing to do.
+	  delaying:  A signal was received, the sort starts when the signal delay expires.
+	  sorting:   A sort is running. If the sort returns False, it continues in the background
+	             and sort_finished() must be called when it is done.
+	  holdoff:   A sort finished, no new sort starts until the sort limit expires.
+	             Signals received in this state queue a sort for when it expires.
+	  suspended: A burst of signals is expected, for example while a server is connecting.
+	             Signals queue a sort for when the burst is over.
+
+	A burst is over when all sources that started one have ended it
+	and no signal arrived for the burst quiet period, or when the burst max duration expires.
+	A burst that starts while sorting suspends sorting once the sort is finished.
+
+	If a CPU share is configured, the signal delay and sort limit are raised so sorting
+	takes at most that share of the time, based on an exponentially weighted average of the sort duration.
+	The signal delay is also raised to the average time between signals when they arrive faster than that,
+	so a sort is more likely to include the next signal.
+	The configured signal delay and sort limit are the lower bound, the max delay is the upper bound.
+
+	There is at most one pending timer and at most one queued sort.
+	The sort, the timers and the clock (in milliseconds) are provided by the caller,
+	so the scheduler can be driven by anything that calls on_timer() when a timer expires.
+	'''
+	IDLE      = 'idle'
+	DELAYING  = 'delaying'
+	SORTING   = 'sorting'
+	HOLDOFF   = 'holdoff'
+	SUSPENDED = 'suspended'
+
+	# Weight of a new sample in the averages of the sort duration and signal interval.
+	SMOOTHING = 0.25
+
+	def __init__(self, sort, start_timer, cancel_timer, clock):
+		self.sort            = sort
+		self.start_timer     = start_timer
+		self.cancel_timer    = cancel_timer
+		self.clock           = clock
+		self.signal_delay    = 0
+		self.sort_limit      = 0
+		self.burst_quiet     = 0
+		self.burst_max       = 0
+		self.cpu_share       = 0
+		self.max_delay       = 0
+		self.sort_duration   = None
+		self.signal_interval = None
+		self.state           = SortScheduler.IDLE
+		self.timer           = None
+		self.queued          = False
+		self.bursts          = set()
+		self.burst_deadline  = None
+		self.last_signal     = None
+
+	def configure(self, signal_delay, sort_limit, burst_quiet = 0, burst_max = 0, cpu_share = 0, max_delay = 0):
+		'''
+		Set the signal delay, sort limit, burst timeouts and max delay in milliseconds. They take effect for the next timer.
+		Bursts are ignored if the burst quiet period or max duration is zero.
+		The signal delay and sort limit are not adapted if the CPU share (in percent) is zero.
+		'''
+		self.signal_delay = signal_delay
+		self.sort_limit   = sort_limit
+		self.burst_quiet  = burst_quiet
+		self.burst_max    = burst_max
+		self.cpu_share    = cpu_share
+		self.max_delay    = max_delay
+
+	def average(self, average, sample):
+		''' Update an exponentially weighted average with a new sample. '''
+		if average is None: return sample
+		return average + SortScheduler.SMOOTHING * (sample - average)
+
+	def clamp(self, value, minimum):
+		''' Clamp an adaptive delay between the configured value and the max delay. '''
+		return max(minimum, min(int(math.ceil(value)), self.max_delay))
+
+	def sort_period(self):
+		''' Get the minimum time in milliseconds between the start of two sorts to stay within the CPU share. '''
+		if self.cpu_share <= 0 or self.sort_duration is None: return None
+		return self.sort_duration * 100.0 / self.cpu_share
+
+	def effective_signal_delay(self):
+		''' Get the signal delay in milliseconds, adapted to the signal rate. '''
+		period = self.sort_period()
+		if period is None or self.signal_interval is None or self.signal_interval >= period:
+			return self.signal_delay
+		return self.clamp(self.signal_interval, self.signal_delay)
+
+	def effective_sort_limit(self):
+		''' Get the sort limit in milliseconds, adapted to the sort duration. '''
+		period = self.sort_period()
+		if period is None: return self.sort_limit
+		return self.clamp(period - self.sort_duration, self.sort_limit)
+
+	def signal(self, name):
+		'''
+		Called when a signal is received that should trigger a sort.
+		Returns False if the signal was coalesced with an earlier signal into a sort that was already coming.
+		'''
+		now = self.clock()
+		if self.last_signal is not None:
+			# Cap the interval so a single long pause does not hide a following flood of signals.
+			interval = min(now - self.last_signal, max(self.max_delay, self.signal_delay))
+			self.signal_interval = self.average(self.signal_interval, interval)
+		self.last_signal = now
+
+		if self.state == SortScheduler.SUSPENDED:
+			if self.queued: return False
+			debug('Signal {0} received during a burst, sort is now queued.'.format(name))
+			self.queued = True
+		elif self.state == SortScheduler.IDLE:
+			signal_delay = self.effective_signal_delay()
+			debug('Signal {0} received, starting signal delay timeout of {1} ms.'.format(name, signal_delay))
+			self.set_state(SortScheduler.DELAYING, signal_delay)
+		elif self.state == SortScheduler.DELAYING:
+			debug('Signal {0} ignored, signal delay timeout active.'.format(name))
+			return False
+		elif self.queued:
+			debug('Signal {0} ignored, sort is already queued.'.format(name))
+			return False
 		else:
-			debug('Signal {0} received but sort limit timeout is active, sort is now queued.'.format(signal))
-		sort_queued = True
-		return weechat.WEECHAT_RC_OK
+			debug('Signal {0} received while {1}, sort is now queued.'.format(name, self.state))
+			self.queued = True
+		return True
+
+	def begin_burst(self, source):
+		''' Called when a burst of signals is expected from a source, like a server that is connecting. '''
+		if self.burst_quiet <= 0 or self.burst_max <= 0: return
+		self.bursts.add(source)
+		if self.state == SortScheduler.SUSPENDED: return
+		if self.state == SortScheduler.SORTING:
+			# The sort can take many time slices, suspend sorting when it is finished.
+			if self.burst_deadline is None:
+				debug('Burst started by {0} while sorting, suspending sorting when the sort is finished.'.format(source))
+				self.burst_deadline = self.clock() + self.burst_max
+			return
 
-	# If the signal delay timeout is started, a signal was recently received, so ignore this signal.
-	if signal_delay_timer is not None:
-		debug('Signal {0} ignored, signal delay timeout active.'.format(signal))
-		return weechat.WEECHAT_RC_OK
+		debug('Burst started by {0}, suspending sorting for at most {1} ms.'.format(source, self.burst_max))
+		if self.state == SortScheduler.DELAYING: self.queued = True
+		self.burst_deadline = self.clock() + self.burst_max
+		self.set_state(SortScheduler.SUSPENDED, self.burst_max)
+
+	def end_burst(self, source):
+		''' Called when a source that started a burst is done, like a server that finished connecting. '''
+		if source not in self.bursts: return
+		self.bursts.discard(source)
+		if self.bursts: return
+		if self.state != SortScheduler.SUSPENDED:
+			# The burst started while sorting, the quiet period starts now.
+			self.last_signal = self.clock()
+			return
 
-	# Otherwise, start the signal delay timeout.
-	debug('Signal {0} received, starting signal delay timeout of {1} ms.'.format(signal, config.signal_delay))
-	weechat.hook_timer(config.signal_delay, 0, 1, "on_signal_delay_timeout", "")
+		debug('Burst ended by {0}, waiting until no signal arrived for {1} ms.'.format(source, self.burst_quiet))
+		self.last_signal = self.clock()
+		self.set_state(SortScheduler.SUSPENDED, self.burst_remaining())
+
+	def burst_remaining(self):
+		''' Get the time in milliseconds until the current burst is over. '''
+		end = self.burst_deadline
+		if not self.bursts: end = min(end, self.last_signal + self.burst_quiet)
+		return max(0, int(math.ceil(end - self.clock())))
+
+	def on_timer(self):
+		''' Called when the pending timer expires. '''
+		self.timer = None
+		if self.state == SortScheduler.SUSPENDED:
+			remaining = self.burst_remaining()
+			if remaining > 0:
+				self.timer = self.start_timer(remaining)
+				return
+			if self.bursts:
+				debug('Burst took longer than {0} ms, resuming sorting.'.format(self.burst_max))
+			self.bursts.clear()
+			self.burst_deadline = None
+			if self.queued:
+				debug('Burst is over, starting queued sort.')
+				self.run_sort()
+			else:
+				debug('Burst is over without receiving a signal.')
+				self.set_state(SortScheduler.IDLE)
+		elif self.state == SortScheduler.DELAYING:
+			debug('Signal delay timeout expired, starting sort.')
+			self.run_sort()
+		elif self.state == SortScheduler.HOLDOFF and self.queued:
+			debug('Signal received during sort limit timeout, starting queued sort.')
+			self.run_sort()
+		else:
+			debug('Sort limit timeout expired without receiving a signal.')
+			self.set_state(SortScheduler.IDLE)
+
+	def run_sort(self):
+		self.set_state(SortScheduler.SORTING)
+		self.queued = False
+		start    = self.clock()
+		finished = True
+		try:
+			finished = self.sort() is not False
+		finally:
+			if finished: self.sort_finished(self.clock() - start)
+
+	def sort_restarted(self):
+		''' Called when a sort in progress starts over, so it includes all signals received so far. '''
+		self.queued = False
+
+	def sort_finished(self, duration):
+		''' Called when a sort is done, with the time in milliseconds spent sorting. '''
+		if self.state != SortScheduler.SORTING: return
+		self.sort_duration = self.average(self.sort_duration, duration)
+
+		if self.burst_deadline is not None:
+			remaining = self.burst_remaining()
+			if remaining > 0:
+				debug('Sort finished during a burst, suspending sorting for at most {0} ms.'.format(remaining))
+				self.set_state(SortScheduler.SUSPENDED, remaining)
+				return
+			self.bursts.clear()
+			self.burst_deadline = None
+
+		sort_limit = self.effective_sort_limit()
+		if sort_limit > 0:
+			debug('Starting sort limit timeout of {0} ms.'.format(sort_limit))
+			self.set_state(SortScheduler.HOLDOFF, sort_limit)
+		elif self.queued:
+			self.queued = False
+			self.set_state(SortScheduler.DELAYING, self.effective_signal_delay())
+		else:
+			self.set_state(SortScheduler.IDLE)
+
+	def set_state(self, state, timeout = None):
+		''' Switch to a new state, replacing the pending timer by a new one if a timeout is given. '''
+		if self.timer is not None:
+			self.cancel_timer(self.timer)
+			self.timer = None
+		self.state = state
+		if timeout is not None:
+			self.timer = self.start_timer(timeout)
+
+class Histogram:
+	'''
+	Counts samples in buckets with fixed upper bounds,
+	and keeps the most recent samples to compute percentiles.
+	'''
+	bounds = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+	def __init__(self, recent = 1000):
+		self.buckets = [0] * (len(Histogram.bounds) + 1)
+		self.recent  = collections.deque(maxlen=recent)
+		self.count   = 0
+		self.total   = 0.0
+		self.maximum = 0.0
+
+	def add(self, value):
+		self.buckets[bisect.bisect_left(Histogram.bounds, value)] += 1
+		self.recent.append(value)
+		self.count  += 1
+		self.total  += value
+		self.maximum = max(self.maximum, value)
+
+	def to_json(self):
+		recent  = sorted(self.recent)
+		buckets = collections.OrderedDict(('<=' + str(bound), count) for bound, count in zip(Histogram.bounds, self.buckets))
+		buckets['>' + str(Histogram.bounds[-1])] = self.buckets[-1]
+		return collections.OrderedDict([
+			('count',   self.count),
+			('total',   round(self.total, 3)),
+			('max',     round(self.maximum, 3)),
+			('p50',     round(percentile(recent, 0.50), 3)),
+			('p90',     round(percentile(recent, 0.90), 3)),
+			('p99',     round(percentile(recent, 0.99), 3)),
+			('buckets', buckets),
+		])
+
+class Stats:
+	'''
+	Runtime statistics of autosort, kept even when debug logging is off.
+	Durations are in milliseconds, the percentiles are over the most recent samples.
+	'''
+	def __init__(self):
+		self.signals   = {}
+		self.counters  = collections.OrderedDict((name, 0) for name in (
+			'signals_coalesced',
+			'signals_unaffected',
+			'sorts_performed',
+			'sorts_skipped',
+			'inserts',
+			'buffers_placed',
+			'buffers_keyed',
+			'buffer_set',
+		))
+		self.sort_duration   = Histogram()
+		self.insert_duration = Histogram()
+
+	def count(self, name, amount = 1):
+		self.counters[name] += amount
+
+	def signal(self, name):
+		self.signals[name] = self.signals.get(name, 0) + 1
+
+	def to_json(self):
+		result = collections.OrderedDict()
+		result['signals'] = collections.OrderedDict(sorted(self.signals.items()))
+		result.update(self.counters)
+		result['sort_duration_ms']   = self.sort_duration.to_json()
+		result['insert_duration_ms'] = self.insert_duration.to_json()
+		return json.dumps(result)
+
+def start_sort_timer(timeout):
+	return weechat.hook_timer(timeout, 0, 1, 'on_sort_timer', '')
+
+def on_sort_timer(data, remaining_calls):
+	''' Called when the timer of the sort scheduler expires. '''
+	scheduler.on_timer()
 	return weechat.WEECHAT_RC_OK
 
-def on_signal_delay_timeout(pointer, remaining_calls):
-	""" Called when the signal_delay_timer triggers. """
-	global signal_delay_timer
-	global sort_limit_timer
-	global sort_queued
-
-	signal_delay_timer = None
-
-	# If the sort limit timeout was started, we're still in the no-sort period, so just queue a sort.
-	if sort_limit_timer is not None:
-		debug('Signal delay timeout expired, but sort limit timeout is active, sort is now queued.')
-		sort_queued = True
-		return weechat.WEECHAT_RC_OK
-
-	# Time to sort!
-	debug('Signal delay timeout expired, starting sort.')
-	do_sort()
-
-	# Start the sort limit timeout if not disabled.
-	if config.sort_limit > 0:
-		debug('Starting sort limit timeout of {0} ms.'.format(config.sort_limit))
-		sort_limit_timer = weechat.hook_timer(config.sort_limit, 0, 1, "on_sort_limit_timeout", "")
+def on_burst_start(data, signal, signal_data):
+	''' Called when a server starts connecting. '''
+	scheduler.begin_burst(signal_data)
+	return weechat.WEECHAT_RC_OK
 
+def on_burst_end(data, signal, signal_data):
+	''' Called when a server is done connecting. '''
+	scheduler.end_burst(signal_data)
 	return weechat.WEECHAT_RC_OK
 
-def on_sort_limit_timeout(pointer, remainin_calls):
-	""" Called when de sort_limit_timer triggers. """
-	global sort_limit_timer
-	global sort_queued
+def on_signal(data, signal, signal_data):
+	global pending_full_sort
 
-	# If no signal was received during the timeout, we're done.
-	if not sort_queued:
-		debug('Sort limit timeout expired without receiving a signal.')
-		sort_limit_timer = None
+	stats.signal(signal)
+	if signal in invalidating_signals and not update_buffer_key(signal, signal_data):
+		debug('Signal {0} did not change the result of any rule, not sorting.'.format(signal))
+		stats.count('signals_unaffected')
 		return weechat.WEECHAT_RC_OK
 
-	# Otherwise it's time to sort.
-	debug('Signal received during sort limit timeout, starting queued sort.')
-	do_sort()
-	sort_queued = False
+	# Remember what changed, so the sort can be done incrementally if possible.
+	if signal == 'buffer_opened':
+		if config.remember_order: place_buffer(signal_data)
+		pending_buffers.append(signal_data)
+	else:
+		pending_full_sort = True
+	invalidate_sort_job()
+
+	if not scheduler.signal(signal): stats.count('signals_coalesced')
+	return weechat.WEECHAT_RC_OK
 
-	# Start the sort limit timeout again if not disabled.
-	if config.sort_limit > 0:
-		debug('Starting sort limit timeout of {0} ms.'.format(config.sort_limit))
-		sort_limit_timer = weechat.hook_timer(config.sort_limit, 0, 1, "on_sort_limit_timeout", "")
 
+def on_buffer_changed(data, signal, signal_data):
+	''' Called when a buffer changed in a way that can affect its sort key. '''
+	if signal == 'buffer_closed': order_memory.forget(signal_data)
+	# Signals that trigger a sort are handled by on_signal, which needs to know if the key changed.
+	if signal not in config.signals:
+		update_buffer_key(signal, signal_data)
 	return weechat.WEECHAT_RC_OK
 
+def changed_inputs(old, new):
+	''' Get the set of inputs of compiled expressions that differ between two loaded BufferInfo. '''
+	changed = set()
+	for field in ('full_name', 'name', 'short_name'):
+		if getattr(old, field) != getattr(new, field): changed.add(('buffer', field))
+	for name in set(old.localvars).union(new.localvars):
+		if old.localvars.get(name, '') != new.localvars.get(name, ''): changed.add(('localvar', name))
+	return changed
+
+def update_buffer_key(signal, buffer):
+	'''
+	Update the cached sort key of a buffer after a signal that can change it.
 
-def apply_config():
-	# Unhook all signals and hook the new ones.
-	for hook in hooks:
-		weechat.unhook(hook)
+	For changed properties, only the rules that read them are evaluated again.
+	Returns False if the sort order can not have changed.
+	'''
+	key = key_cache.get(buffer) if signal in property_signals else None
+	if key is not None:
+		info = BufferInfo(buffer, key.buffer.number)
+		info.load(weechat.hdata_get('buffer'))
+		rules      = config.rules_reading(changed_inputs(key.buffer, info))
+		key.buffer = info
+		if not rules or not KeyEvaluator(config).refresh(key, rules): return False
+	elif signal not in ('buffer_merged', 'buffer_unmerged'):
+		# Merging doesn't change the key of a buffer, only how buffers are grouped.
+		key_cache.pop(buffer, None)
+
+	invalidate_sort_job()
+
+	# The last applied order can't be trusted anymore if one of its buffers changed.
+	if buffer_order is not None and buffer in buffer_order.buffers:
+		set_buffer_order(None, None)
+	return True
+
+def reconcile_hooks():
+	'''
+	Make sure every configured signal has exactly one hook calling on_signal, and no other signal has one.
+	Only signals that were added or removed are hooked or unhooked.
+	'''
+	wanted = set(config.signals)
+	for signal in [signal for signal in hooks if signal not in wanted]:
+		weechat.unhook(hooks.pop(signal))
 	for signal in config.signals:
-		hooks.append(weechat.hook_signal(signal, 'on_signal', ''))
+		if signal not in hooks:
+			hooks[signal] = weechat.hook_signal(signal, 'on_signal', '')
 
-	if config.sort_on_config:
-		debug('Sorting because configuration changed.')
-		do_sort()
+def apply_config(changed = None):
+	'''
+	Apply the configuration to the signal hooks, the scheduler and the buffer list.
+	If a set of changed attributes of the configuration is given, only what depends on them is redone.
+	'''
+	if changed is None or 'signals' in changed:
+		reconcile_hooks()
+
+	if changed is None or not changed.isdisjoint(Config.timing_options):
+		scheduler.configure(config.signal_delay, config.sort_limit, config.burst_quiet, config.burst_max, config.cpu_share, config.max_delay)
+
+	if changed is None or not changed.isdisjoint(Config.key_options):
+		# The cached keys are cleared by Config.reload(), anything built on them is stale too.
+		set_buffer_order(None, None)
+		invalidate_sort_job()
+		if config.sort_on_config:
+			debug('Sorting because configuration changed.')
+			do_sort()
+
+def on_unload():
+	''' Called when the script is unloaded or weechat quits. '''
+	order_memory.save()
+	return weechat.WEECHAT_RC_OK
 
 def on_config_changed(*args, **kwargs):
 	''' Called whenever the configuration changes. '''
-	config.reload()
-	apply_config()
+	changed = config.reload()
+	if changed:
+		debug('Configuration changed: {0}.'.format(', '.join(sorted(changed))))
+		apply_config(changed)
 
 	return weechat.WEECHAT_RC_OK
 
-def parse_arg(args):
-	if not args: return '', None
-
-	result  = ''
-	escaped = False
-	for i, c in enumerate(args):
-		if not escaped:
-			if c == '\\':
-				escaped = True
-				continue
-			elif c == ',':
-				return result, args[i+1:]
-		result  += c
-		escaped  = False
-	return result, None
+argument_pattern = re.compile(r'((?:[^\\,]|\\.)*)\\?(,?)', re.DOTALL)
+escape_pattern   = re.compile(r'\\(.)', re.DOTALL)
+
+class LruCache:
+	''' A dictionary with a maximum size that forgets the least recently used entries. '''
+	def __init__(self, size):
+		self.size    = size
+		self.entries = collections.OrderedDict()
+
+	def get(self, key):
+		try:
+			value = self.entries.pop(key)
+		except KeyError:
+			return None
+		self.entries[key] = value
+		return value
+
+	def set(self, key, value):
+		self.entries[key] = value
+		if len(self.entries) > self.size: self.entries.popitem(last = False)
+
+# The same argument strings tend to be parsed for every buffer.
+parsed_args_cache = LruCache(256)
 
 def parse_args(args, max = None):
-	result = []
-	i = 0
-	while max is None or i < max:
-		i += 1
-		arg, args = parse_arg(args)
-		if arg is None: break
-		result.append(arg)
-		if args is None: break
-	return result, args
+	'''
+	Split an argument string on unescaped commas and unescape the arguments.
+	At most max arguments are parsed, the unparsed rest is returned as second element of the result.
+	If everything has been parsed, the rest is None.
+	'''
+	cached = parsed_args_cache.get((args, max))
+	if cached is not None: return list(cached[0]), cached[1]
+
+	result   = []
+	finished = False
+	position = 0
+	while max is None or len(result) < max:
+		match = argument_pattern.match(args, position)
+		value = match.group(1)
+		result.append(escape_pattern.sub(r'\1', value) if '\\' in value else value)
+		if not match.group(2):
+			finished = True
+			break
+		position = match.end()
+
+	# Only slice the rest once, if max stopped the loop early.
+	rest = None if finished else args[position:]
+
+	parsed_args_cache.set((args, max), (tuple(result), rest))
+	return result, rest
+
+def escape_arg(text):
+	''' Escape commas and backslashes in an argument for an autosort info hook. '''
+	return text.replace('\\', '\\\\').replace(',', '\\,')
 
 def on_info_escape(pointer, name, arguments):
-	result = ''
-	for c in arguments:
-		if c == '\\':
-			result += '\\\\'
-		elif c == ',':
-			result += '\\,'
-		else:
-			result +=c
-	return result
+	return escape_arg(arguments)
 
 def on_info_replace(pointer, name, arguments):
 	arguments, rest = parse_args(arguments, 3)
+	return info_replace(name, arguments, rest)
+
+def info_replace(name, arguments, rest):
 	if rest or len(arguments) < 3:
 		log('usage: ${{info:{0},old,new,text}}'.format(name))
 		return ''
@@ -777,24 +2610,38 @@ def on_info_replace(pointer, name, arguments):
 
 	return text.replace(old, new)
 
+def on_info_stats(pointer, name, arguments):
+	return stats.to_json()
+
 def on_info_order(pointer, name, arguments):
 	arguments, rest = parse_args(arguments)
+	return info_order(name, arguments)
+
+def info_order(name, arguments):
 	if len(arguments) < 1:
 		log('usage: ${{info:{0},value,first,second,third,...}}'.format(name))
 		return ''
 
-	value = arguments[0]
-	keys  = arguments[1:]
-	if not keys: return '0'
+	return OrderTable(arguments[1:]).lookup(arguments[0])
+
+class OrderTable:
+	''' The results of ${info:autosort_order} for a list of options. '''
+	def __init__(self, options):
+		self.results = {}
+		if not options:
+			self.default = '0'
+			return
+
+		# Pad results with leading zero to make sure string sorting works.
+		width = int(math.log10(len(options))) + 1
+		for i, option in enumerate(options):
+			if option not in self.results: self.results[option] = '{0:0{1}}'.format(i, width)
 
-	# Find the value in the keys (or '*' if we can't find it)
-	result = list_find(keys, value)
-	if result is None: result = list_find(keys, '*')
-	if result is None: result = len(keys)
+		# Values that aren't an option sort at the position of '*', or after all options.
+		self.default = self.results.get('*', '{0:0{1}}'.format(len(options), width))
 
-	# Pad result with leading zero to make sure string sorting works.
-	width = int(math.log10(len(keys))) + 1
-	return '{0:0{1}}'.format(result, width)
+	def lookup(self, value):
+		return self.results.get(value, self.default)
 
 
 def on_autosort_command(data, buffer, args):
@@ -804,6 +2651,9 @@ def on_autosort_command(data, buffer, args):
 			' ':      command_sort,
 			'sort':   command_sort,
 			'debug':  command_debug,
+			'profile': command_profile,
+			'dump':    command_dump,
+			'hooks':   command_hooks,
 
 			'rules': {
 				' ':         command_rule_list,
@@ -874,7 +2724,7 @@ def on_autosort_complete(data, name, buffer, completion):
 	if prefix[-1] != ' ': words = words[:-1]
 
 	if len(words) == 0:
-		add_completions(completion, ['debug', 'helpers', 'rules', 'sort'])
+		add_completions(completion, ['debug', 'dump', 'helpers', 'hooks', 'profile', 'rules', 'sort'])
 	elif words[0] == 'rules':
 		return autosort_complete_rules(words[1:], completion)
 	elif words[0] == 'helpers':
@@ -885,10 +2735,29 @@ command_description = r'''{*white}# General commands{reset}
 
 {*white}/autosort {brown}sort{reset}
 Manually trigger the buffer sorting.
+This evaluates the sort rules for all buffers again, without using cached results.
 
 {*white}/autosort {brown}debug{reset}
-Show the evaluation results of the sort rules for each buffer.
-
+Show which sort rules and helpers are compiled to python, which buffer properties
+each rule reads, and the evaluation results of the sort rules for each buffer.
+
+{*white}/autosort {brown}hooks{reset}
+Show the signals autosort is hooked to. Every signal in {cyan}autosort.sorting.signals{reset}
+has exactly one hook that triggers a sort.
+
+{*white}/autosort {brown}profile {cyan}[runs]{reset}
+Sort the buffers without cached results a number of times (1 by default) and show
+how much time is spent in each rule and helper, and in each phase of sorting:
+reading the buffer list, evaluating keys, sorting and moving buffers.
+The buffers are put back in their starting order before each run. The profile
+does not change the cached sort keys or the {cyan}autosort_stats{reset} info.
+
+{*white}/autosort {brown}dump {cyan}<file>{reset}
+Write the buffer list and the sort configuration to {cyan}file{reset}, to reproduce slow
+sorting outside of weechat. Relative paths are relative to the weechat data
+directory. The first line holds the rules, helpers and sorting options as JSON,
+followed by one line per buffer with its number, full name, name, short name and
+local variables. Buffers with the same number are merged.
 
 {*white}# Sorting rule commands{reset}
 
@@ -961,6 +2830,13 @@ Otherwise, an eval string that expands to something with a comma would be interp
 For example, it can be used to safely pass buffer names to {cyan}${{info:autosort_replace}}{reset} like so:
 {cyan}${{info:autosort_replace,##,#,${{info:autosort_escape,${{buffer.name}}}}}}{reset}.
 
+{*white}${{info:{brown}autosort_stats{white}}}{reset}
+Runtime statistics of autosort as JSON: signals received per signal, signals that
+were coalesced or didn't change any sort key, sorts performed and skipped, buffers
+keyed, buffers placed at their remembered position, buffer_set calls and histograms
+and percentiles of sort durations in milliseconds.
+The statistics are kept even if {cyan}autosort.sorting.debug_log{reset} is off.
+
 
 {*white}# Description
 Autosort is a weechat script to automatically keep your buffers sorted. The sort
@@ -980,6 +2856,14 @@ considered for sorting purposes.
 You can debug your sort rules with the `{*default}/autosort debug{reset}` command, which will
 print the evaluation results of each rule for each buffer.
 
+Common expressions like buffer properties, local variables, simple {cyan}${{if:...}}{reset}
+conditions and {cyan}${{info:...}}{reset} are compiled to python when the rules are loaded,
+which is a lot faster than evaluating them with weechat for every buffer. Anything
+else is still evaluated by weechat, `{*default}/autosort debug{reset}` shows which rules and
+helpers are compiled. When a buffer is renamed or its local variables change, only
+the rules that read a changed value are evaluated again, and the buffers are not
+sorted at all if none of their results changed.
+
 {*brown}NOTE:{reset} The sort rules for version 3 are not compatible with version 2 or vice
 versa. You will have to manually port your old rules to version 3 if you have any.
 
@@ -987,7 +2871,9 @@ versa. You will have to manually port your old rules to version 3 if you have an
 You may define helper variables for the main sort rules to keep your rules
 readable. They can be used in the main sort rules as variables. For example,
 a helper variable named `{cyan}foo{reset}` can be accessed in a main rule with the
-string `{cyan}${{foo}}{reset}`.
+string `{cyan}${{foo}}{reset}`. Helper variables can also be used in other helper
+variables. Only the helper variables that are used by the main sort rules are
+evaluated.
 
 {*white}# Automatic or manual sorting{reset}
 By default, autosort will automatically sort your buffer list whenever a buffer
@@ -1000,6 +2886,36 @@ If you remove all signals you can still sort your buffers manually with the
 `{*default}/autosort sort{reset}` command. To prevent all automatic sorting, the option
 `{cyan}autosort.sorting.sort_on_config_change{reset}` should also be disabled.
 
+While an IRC server is connecting and joining channels, sorting is suspended
+until the server is connected and no signal arrived for
+`{cyan}autosort.sorting.burst_quiet_period{reset}` milliseconds, or until
+`{cyan}autosort.sorting.burst_max_duration{reset}` milliseconds have passed.
+The buffers are then sorted once. Set either option to 0 to disable this.
+
+Autosort measures how long sorting takes and how quickly signals arrive. The
+signal delay and sort limit are raised up to `{cyan}autosort.sorting.max_delay{reset}`
+so that sorting takes at most `{cyan}autosort.sorting.cpu_share{reset}` percent of the time.
+The configured `{cyan}autosort.sorting.signal_delay{reset}` and `{cyan}autosort.sorting.sort_limit{reset}`
+are never lowered. The delays currently in use are shown by `{*default}/autosort debug{reset}`.
+
+With a very large buffer list, evaluating the sort rules can take a while. To
+keep weechat responsive, an automatic sort blocks weechat for at most
+`{cyan}autosort.sorting.time_slice{reset}` milliseconds at a time. The new order is applied
+in one go once all buffers are evaluated.
+
+The first `{cyan}autosort.sorting.partition_rules{reset}` rules split the buffer list in
+partitions, like one partition per server with the default rules. As long as the
+partitions are in order, only the partitions that are out of order are sorted.
+
+Autosort remembers the sorted order of your buffers by full name in
+{cyan}autosort_order.json{reset} in the weechat data directory. When a buffer that was seen
+before is opened, it is moved to its remembered position right away, so buffers
+don't have to be moved over and over while weechat starts or a server reconnects.
+The next sort only moves buffers whose position was predicted wrong. Buffers
+that weren't open for 30 days are forgotten. The file is written a minute after
+the order changes and when autosort is unloaded. Set
+`{cyan}autosort.sorting.remember_order{reset}` to {brown}off{reset} to disable this.
+
 {*white}# Recommended settings
 For the best visual effect, consider setting the following options:
 {*white}/set {cyan}irc.look.server_buffer{reset} {brown}independent{reset}
@@ -1038,9 +2954,20 @@ info_escape_description = (
 )
 info_escape_arguments = 'text'
 
+info_stats_description = (
+	'Runtime statistics of autosort as JSON: the number of signals received per signal, '
+	'the number of signals that were coalesced into an already scheduled sort or did not change any sort key, '
+	'the number of sorts performed and skipped, buffers keyed, buffers placed at their remembered position and buffer_set calls, '
+	'and histograms and percentiles of sort durations in milliseconds.'
+)
+info_stats_arguments = ''
+
 
-if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE, SCRIPT_DESC, "", ""):
-	config = Config('autosort')
+if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE, SCRIPT_DESC, "on_unload", ""):
+	stats        = Stats()
+	order_memory = OrderMemory(data_path('autosort_order.json'))
+	config       = Config('autosort')
+	scheduler    = SortScheduler(do_queued_sort, start_sort_timer, weechat.unhook, lambda: perf_counter() * 1000)
 
 	colors = {
 		'default':  weechat.color('default'),
@@ -1072,5 +2999,14 @@ if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE,
 	weechat.hook_info('autosort_escape',  info_escape_description,  info_escape_arguments,  'on_info_escape', '')
 	weechat.hook_info('autosort_replace', info_replace_description, info_replace_arguments, 'on_info_replace', '')
 	weechat.hook_info('autosort_order',   info_order_description,   info_order_arguments,   'on_info_order',   '')
+	weechat.hook_info('autosort_stats',   info_stats_description,   info_stats_arguments,   'on_info_stats',   '')
+
+	for signal in invalidating_signals:
+		weechat.hook_signal(signal, 'on_buffer_changed', '')
+	for signal in burst_start_signals:
+		weechat.hook_signal(signal, 'on_burst_start', '')
+	for signal in burst_end_signals:
+		weechat.hook_signal(signal, 'on_burst_end', '')
 
+	order_memory.load(today())
 	apply_config()
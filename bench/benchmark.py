@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmark the autosort sorting pipeline outside of weechat.
+#
+# Autosort is loaded with the stand-in weechat module from this directory,
+# on synthetic buffer lists of many servers with many channels each.
+# Every scenario is run for every rule set and buffer list size,
+# and the best time of a number of repetitions is reported.
+#
+# Usage:
+#   python bench/benchmark.py [--sizes 100,1000,5000,20000] [--repeat 3]
+#   python bench/benchmark.py --save     Store the results as the new baseline.
+#
+# If a baseline exists, results that are slower than the baseline by more than
+# the threshold are reported as regressions, and the exit status is 1.
+# Baselines are only comparable between runs on the same machine and python version.
+#
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+sys.path.insert(0, bench_dir)
+
+import weechat
+
+if hasattr(time, 'perf_counter'):
+	perf_counter = time.perf_counter
+else:
+	perf_counter = time.clock
+
+default_baseline = os.path.join(bench_dir, 'baseline.json')
+
+# Rule sets to benchmark. None means the default rules and helpers of autosort.
+rule_sets = {
+	'default': None,
+	'heavy': {
+		'rules': [
+			'${core_first}',
+			'${info:autosort_order,${info:autosort_escape,${script_or_plugin}},core,*,irc,bitlbee,matrix,slack}',
+			'${script_or_plugin}',
+			'${irc_raw_first}',
+			'${network}',
+			'${kind}',
+			'${grouped_name}',
+			'${if:${buffer.name}=~[0-9]$?${buffer.short_name}:${type}}',
+			'${buffer.full_name}',
+		],
+		'helpers': {
+			'core_first':       '${if:${buffer.full_name}!=core.weechat}',
+			'irc_raw_first':    '${if:${buffer.full_name}!=irc.irc_raw}',
+			'hashless_name':    '${info:autosort_replace,#,,${info:autosort_escape,${buffer.name}}}',
+			'script_or_plugin': '${if:${script_name}?${script_name}:${plugin}}',
+			'network':          '${info:autosort_order,${server},net0,net3,*,net1}',
+			'kind':             '${if:${type}==channel&&${buffer.name}=~#?channel:${type}}',
+			'grouped_name':     '${network}.${info:autosort_replace,_,,${hashless_name}}',
+		},
+	},
+}
+
+channel_words = ['linux', 'python', 'weechat', 'Rust', 'go-nuts', 'help', 'dev', 'ops', 'offtopic', 'C++']
+
+
+def populate(rng, size):
+	''' Open a synthetic list of `size` buffers in the fake weechat, in random order. '''
+	items = [('core', 'weechat', {}), ('irc', 'irc_raw', {})]
+	for i in range(3):
+		items.append(('python', 'script{0}'.format(i), {'script_name': 'script{0}'.format(i)}))
+	items.append(('fset', 'fset', {}))
+
+	servers = max(1, size // 200)
+	for i in range(servers):
+		items.append(('irc', 'server.net{0}'.format(i), {'server': 'net{0}'.format(i), 'type': 'server'}))
+
+	while len(items) < size:
+		server = 'net{0}'.format(len(items) % servers)
+		if rng.random() < 0.1:
+			items.append(('irc', '{0}.nick{1}'.format(server, len(items)), {'server': server, 'type': 'private'}))
+		else:
+			channel = '#{0}{1}'.format(rng.choice(channel_words), len(items))
+			items.append(('irc', '{0}.{1}'.format(server, channel), {'server': server, 'type': 'channel', 'channel': channel}))
+
+	rng.shuffle(items)
+	for plugin, name, localvars in items:
+		weechat.add_buffer(plugin, name, localvars, signal=False)
+
+def perturb(rng, fraction = 0.01):
+	''' Move a fraction of the buffers to a random position, like buffers that were opened or renamed. '''
+	for i in range(max(1, int(len(weechat.buffers) * fraction))):
+		buffer = rng.choice(weechat.buffers)
+		weechat.buffer_set(buffer.pointer, 'number', str(rng.randint(1, len(weechat.buffers))))
+
+def load_autosort(rule_set):
+	''' Load a fresh copy of autosort with the given rule set. '''
+	weechat.reset()
+	sys.modules.pop('autosort', None)
+	autosort = __import__('autosort')
+	# Scheduled sorts and bursts follow the fake clock, like the timers that drive them.
+	autosort.scheduler.clock = weechat.clock
+	if rule_set is not None:
+		weechat.config_option_set('autosort.v3.helpers', json.dumps(rule_set['helpers']), 1)
+		weechat.config_option_set('autosort.v3.rules',   json.dumps(rule_set['rules']),   1)
+	return autosort
+
+def arrange(autosort):
+	''' Put the buffers of the fake weechat in sorted order without moving them one by one, and cache their keys. '''
+	buffers = autosort.merge_buffer_list(autosort.get_buffers())
+	order   = autosort.sort_level(autosort.key_buffers(buffers, autosort.config, autosort.key_cache), 0, len(autosort.config.rules))
+	for number, (key, merged) in enumerate(order, 1):
+		for buffer in merged:
+			weechat.find_buffer(buffer.pointer).number = number
+	weechat._renumber()
+
+def clear_cache(autosort):
+	autosort.key_cache.clear()
+	autosort.set_buffer_order(None, None)
+
+
+# Scenarios take the loaded autosort module and a random generator.
+# They get a sorted buffer list, do their setup and return a function that runs the code to time.
+
+def scenario_sort_cold(autosort, rng):
+	''' Full sort of a slightly unsorted list without cached keys. '''
+	perturb(rng)
+	clear_cache(autosort)
+	return autosort.do_sort
+
+def scenario_sort_warm(autosort, rng):
+	''' Full sort of a slightly unsorted list with all keys cached. '''
+	perturb(rng)
+	autosort.set_buffer_order(None, None)
+	return autosort.do_sort
+
+def scenario_sort_sorted(autosort, rng):
+	''' Sort of an already sorted list with all keys cached. '''
+	autosort.set_buffer_order(None, None)
+	return autosort.do_sort
+
+def scenario_sort_key(autosort, rng):
+	''' Evaluate all rules for all buffers with buffer_sort_key(). '''
+	buffers = autosort.get_buffers()
+	def run():
+		key = autosort.buffer_sort_key(autosort.config)
+		for buffer in buffers: key(buffer)
+	return run
+
+def scenario_info_hooks(autosort, rng):
+	''' Call the autosort info hooks once per buffer each, like uncompiled rules would. '''
+	names = [buffer.name for buffer in weechat.buffers]
+	def run():
+		for name in names:
+			escaped = autosort.on_info_escape(None, 'autosort_escape', name)
+			autosort.on_info_replace(None, 'autosort_replace', '#,,' + escaped)
+			autosort.on_info_order(None, 'autosort_order', escaped + ',core,*,irc,bitlbee,matrix,slack')
+	return run
+
+def scenario_apply(autosort, rng):
+	''' Apply a sorted order to a slightly unsorted list. '''
+	perturb(rng)
+	buffers = autosort.merge_buffer_list(autosort.get_buffers())
+	order   = autosort.sort_level(autosort.key_buffers(buffers, autosort.config), 0, len(autosort.config.rules))
+	return lambda: autosort.apply_buffer_order([merged for key, merged in order])
+
+scenarios = [
+	('do_sort cold',        scenario_sort_cold),
+	('do_sort warm',        scenario_sort_warm),
+	('do_sort sorted',      scenario_sort_sorted),
+	('buffer_sort_key',     scenario_sort_key),
+	('info hooks',          scenario_info_hooks),
+	('apply_buffer_order',  scenario_apply),
+]
+
+
+def measure(rule_set_name, size, scenario, repeat, seed):
+	''' Get the best time in seconds of a number of runs of a scenario. '''
+	best = None
+	for i in range(repeat):
+		rng      = random.Random(seed + i)
+		autosort = load_autosort(rule_sets[rule_set_name])
+		populate(rng, size)
+		arrange(autosort)
+		run      = scenario(autosort, rng)
+		start    = perf_counter()
+		run()
+		elapsed  = perf_counter() - start
+		best     = elapsed if best is None else min(best, elapsed)
+	return best
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark autosort with a fake weechat module.')
+	parser.add_argument('--sizes',     default='100,1000,5000,20000', help='comma separated buffer list sizes')
+	parser.add_argument('--rules',     default=','.join(sorted(rule_sets)), help='comma separated rule sets')
+	parser.add_argument('--repeat',    type=int, default=3, help='number of runs per measurement, the best one counts')
+	parser.add_argument('--seed',      type=int, default=1, help='seed for the synthetic buffer lists')
+	parser.add_argument('--baseline',  default=default_baseline, help='baseline file to compare with or save to')
+	parser.add_argument('--threshold', type=float, default=0.25, help='relative slowdown that counts as a regression')
+	parser.add_argument('--save',      action='store_true', help='save the results as the new baseline')
+	args = parser.parse_args()
+
+	baseline = {}
+	if os.path.exists(args.baseline) and not args.save:
+		with open(args.baseline) as file:
+			baseline = json.load(file)
+
+	results     = {}
+	regressions = []
+	for rule_set_name in args.rules.split(','):
+		for size in [int(size) for size in args.sizes.split(',')]:
+			for scenario_name, scenario in scenarios:
+				name    = '{0} {1} {2}'.format(rule_set_name, size, scenario_name)
+				elapsed = measure(rule_set_name, size, scenario, args.repeat, args.seed)
+				results[name] = elapsed
+
+				line = '{0:<40} {1:>10.3f} ms'.format(name, elapsed * 1000)
+				if name in baseline:
+					change = elapsed / baseline[name] - 1 if baseline[name] > 0 else 0.0
+					line  += '  {0:>+7.1f}% vs {1:.3f} ms'.format(change * 100, baseline[name] * 1000)
+					if change > args.threshold:
+						line += '  REGRESSION'
+						regressions.append(name)
+				print(line)
+				sys.stdout.flush()
+
+	if args.save:
+		with open(args.baseline, 'w') as file:
+			json.dump(results, file, indent=1, sort_keys=True)
+		print('Saved baseline to {0}.'.format(args.baseline))
+	elif regressions:
+		print('{0} regression(s) of more than {1:.0f}%:'.format(len(regressions), args.threshold * 100))
+		for name in regressions: print('    ' + name)
+		return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
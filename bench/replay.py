@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Replay a buffer list written by `/autosort dump` outside of weechat.
+#
+# The dumped buffers are opened in the stand-in weechat module in their dumped order,
+# with the dumped rules, helpers and sorting options, and then sorted.
+# This reports the time it takes to sort the buffer list from the dumped order and when it is already sorted,
+# and optionally the output of `/autosort profile` and the resulting buffer order.
+#
+# Usage:
+#   python bench/replay.py <dump> [--repeat 3] [--profile runs] [--order]
+#
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+from benchmark import load_autosort, perf_counter
+import weechat
+
+
+def read_dump(path):
+	''' Read a dump file into the config record and a list of buffer records. '''
+	config  = None
+	buffers = []
+	with open(path) as file:
+		for line in file:
+			if not line.strip(): continue
+			record = json.loads(line)
+			if record['type'] == 'config':
+				config = record
+			elif record['type'] == 'buffer':
+				buffers.append(record)
+	if config is None: raise ValueError('{0}: no config record found'.format(path))
+	return config, buffers
+
+def restore(config, buffers):
+	''' Load a fresh copy of autosort and open the dumped buffers in the fake weechat. '''
+	autosort = load_autosort({'rules': config['rules'], 'helpers': config['helpers']})
+	weechat.config_option_set('autosort.sorting.case_sensitive',  'on' if config['case_sensitive'] else 'off', 1)
+	weechat.config_option_set('autosort.sorting.partition_rules', str(config['partition_rules']), 1)
+
+	for record in buffers:
+		localvars = record['localvars']
+		buffer = weechat.add_buffer(localvars.get('plugin', record['full_name'].split('.', 1)[0]), record['name'], signal=False)
+		buffer.full_name  = record['full_name']
+		buffer.short_name = record['short_name']
+		buffer.localvars  = dict(localvars)
+		buffer.number     = record['number']
+	weechat._renumber()
+	return autosort
+
+def main():
+	parser = argparse.ArgumentParser(description='Replay a buffer list written by /autosort dump.')
+	parser.add_argument('dump', help='file written by /autosort dump')
+	parser.add_argument('--repeat',  type=int, default=3, help='number of runs per measurement, the best one counts')
+	parser.add_argument('--profile', type=int, default=0, help='also show the output of /autosort profile with this many runs')
+	parser.add_argument('--order',   action='store_true', help='print the sorted buffer list')
+	args = parser.parse_args()
+
+	config, buffers = read_dump(args.dump)
+	print('{0}: {1} buffer(s), {2} rule(s), {3} helper(s), dumped by autosort {4}'.format(
+		args.dump, len(buffers), len(config['rules']), len(config['helpers']), config['version']))
+
+	cold   = None
+	warm   = None
+	for i in range(args.repeat):
+		autosort = restore(config, buffers)
+		moves    = weechat.calls.get('buffer_set', 0)
+
+		start = perf_counter()
+		autosort.do_sort()
+		elapsed = perf_counter() - start
+		cold    = elapsed if cold is None else min(cold, elapsed)
+		moves   = weechat.calls.get('buffer_set', 0) - moves
+
+		autosort.set_buffer_order(None, None)
+		start = perf_counter()
+		autosort.do_sort()
+		elapsed = perf_counter() - start
+		warm    = elapsed if warm is None else min(warm, elapsed)
+
+	print('do_sort from dumped order: {0:10.3f} ms, {1} buffer_set call(s)'.format(cold * 1000, moves))
+	print('do_sort when sorted:       {0:10.3f} ms'.format(warm * 1000))
+
+	if args.order:
+		for buffer in weechat.buffers:
+			print('{0:>6} {1}'.format(buffer.number, buffer.full_name))
+
+	if args.profile > 0:
+		autosort = restore(config, buffers)
+		autosort.command_profile('', ['/autosort', 'profile'], str(args.profile))
+		for message in weechat.messages: print(message)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+#
+# A stand-in for the weechat module, implementing just enough of the scripting
+# API to load autosort and run its sorting pipeline outside of weechat.
+#
+# The eval implementation is simplified, but faithful for the default rules.
+# Buffers are kept in a list sorted by number, like the gui_buffers list of weechat.
+# Timers run on a fake clock that only moves when advance() or run_timers() is called.
+# The harness uses clock() as the clock of the autosort sort scheduler, so bursts and delays follow it too.
+#
+
+from __future__ import print_function
+
+import atexit
+import re
+import shutil
+import sys
+import tempfile
+
+WEECHAT_RC_OK    = 0
+WEECHAT_RC_ERROR = -1
+WEECHAT_RC_OK_EAT = 1
+
+WEECHAT_CONFIG_READ_OK = 0
+WEECHAT_CONFIG_WRITE_OK = 0
+WEECHAT_CONFIG_OPTION_SET_OK_CHANGED = 2
+
+WEECHAT_LIST_POS_SORT      = 'sort'
+WEECHAT_LIST_POS_BEGINNING = 'beginning'
+WEECHAT_LIST_POS_END       = 'end'
+
+# Namespace of the registered script, callbacks are looked up by name in it like the real plugin does.
+script = None
+
+# Print messages to stdout instead of collecting them.
+verbose = False
+
+now       = 0
+messages  = []
+buffers   = []
+pointers  = {}
+positions = {}
+timers    = []
+hooks     = {}
+infos     = {}
+options   = {}
+calls     = {}
+# Files written by the script go to a temporary directory that is removed at exit.
+data_dir  = tempfile.mkdtemp(prefix='autosort-')
+atexit.register(shutil.rmtree, data_dir, True)
+
+_next_pointer = [0x1000]
+
+
+def _count(name):
+	calls[name] = calls.get(name, 0) + 1
+
+def _pointer():
+	_next_pointer[0] += 0x10
+	return '0x{0:x}'.format(_next_pointer[0])
+
+def _callback(name):
+	return script[name]
+
+def _changed():
+	''' Forget the positions of the buffers in the list after it changed. '''
+	positions.clear()
+
+def _position(buffer):
+	if not positions:
+		positions.update((other.pointer, i) for i, other in enumerate(buffers))
+	return positions[buffer.pointer]
+
+
+class Buffer(object):
+	def __init__(self, plugin, name, localvars = None, short_name = None):
+		self.pointer    = _pointer()
+		self.plugin     = plugin
+		self.name       = name
+		self.full_name  = '{0}.{1}'.format(plugin, name)
+		self.short_name = short_name if short_name is not None else name
+		self.number     = 0
+		self.hidden     = 0
+		self.localvars  = {'plugin': plugin, 'name': name}
+		self.localvars.update(localvars or {})
+
+
+def reset():
+	''' Forget all state. '''
+	global now, script
+	now = 0
+	script = None
+	del messages[:]
+	del buffers[:]
+	del timers[:]
+	pointers.clear()
+	positions.clear()
+	hooks.clear()
+	infos.clear()
+	options.clear()
+	calls.clear()
+
+def find_buffer(pointer):
+	return pointers.get(pointer)
+
+def _renumber():
+	''' Sort the buffer list by number and remove gaps in the numbering. '''
+	_changed()
+	buffers.sort(key=lambda buffer: buffer.number)
+	number = 0
+	previous = None
+	for buffer in buffers:
+		if buffer.number != previous:
+			number += 1
+			previous = buffer.number
+		buffer.number = number
+
+def add_buffer(plugin, name, localvars = None, short_name = None, signal = True):
+	''' Open a new buffer at the end of the buffer list. '''
+	buffer = Buffer(plugin, name, localvars, short_name)
+	buffer.number = (buffers[-1].number + 1) if buffers else 1
+	buffers.append(buffer)
+	pointers[buffer.pointer] = buffer
+	_changed()
+	if signal: send_signal('buffer_opened', buffer.pointer)
+	return buffer
+
+def close_buffer(buffer, signal = True):
+	''' Close a buffer, moving the buffers after it up. '''
+	if signal: send_signal('buffer_closing', buffer.pointer)
+	buffers.remove(buffer)
+	del pointers[buffer.pointer]
+	_renumber()
+	if signal: send_signal('buffer_closed', buffer.pointer)
+
+def merge_buffers(buffer, target, signal = True):
+	''' Merge a buffer into the buffer group of target. '''
+	buffer.number = target.number
+	_renumber()
+	if signal: send_signal('buffer_merged', buffer.pointer)
+
+def rename_buffer(buffer, name, signal = True):
+	''' Rename a buffer, which also changes its full name and short name. '''
+	buffer.name = name
+	buffer.full_name = '{0}.{1}'.format(buffer.plugin, name)
+	buffer.short_name = name
+	buffer.localvars['name'] = name
+	if signal: send_signal('buffer_renamed', buffer.pointer)
+
+def set_localvar(buffer, name, value, signal = True):
+	''' Add or change a local variable of a buffer. '''
+	existed = name in buffer.localvars
+	buffer.localvars[name] = value
+	if signal: send_signal('buffer_localvar_changed' if existed else 'buffer_localvar_added', buffer.pointer)
+
+def buffer_names():
+	''' Get the full names of all buffers in order. '''
+	return [buffer.full_name for buffer in buffers]
+
+def send_signal(signal, signal_data = ''):
+	''' Call the callbacks of all hooks on a signal. '''
+	for hook in list(hooks.values()):
+		if hook[0] == 'signal' and hook[1] == signal:
+			_callback(hook[2])(hook[3], signal, signal_data)
+
+def clock():
+	''' Get the time of the fake clock in milliseconds. '''
+	return now
+
+def advance(milliseconds):
+	''' Advance the fake clock, running any timer that expires. '''
+	global now
+	end = now + milliseconds
+	while True:
+		pending = [timer for timer in timers if timer[0] <= end]
+		if not pending: break
+		timer = min(pending, key=lambda timer: timer[0])
+		timers.remove(timer)
+		now = timer[0]
+		hooks.pop(timer[1], None)
+		_callback(timer[2])(timer[3], 0)
+	now = end
+
+def run_timers():
+	''' Run timers until none are left. '''
+	while timers:
+		advance(min(timer[0] for timer in timers) - now)
+
+
+# Script registration and output.
+
+def register(name, author, version, license, description, shutdown_function, charset):
+	global script
+	script = sys._getframe(1).f_globals
+	return True
+
+def prnt(buffer, message):
+	messages.append(message)
+	if verbose: print(message)
+
+def color(name):
+	return ''
+
+def info_get(name, arguments):
+	if name in ('weechat_data_dir', 'weechat_dir'): return data_dir
+	if name == 'version_number': return '0x4000000'
+	if name in infos: return _callback(infos[name][0])(infos[name][1], name, arguments)
+	return ''
+
+
+# Hooks.
+
+def _hook(*hook):
+	pointer = _pointer()
+	hooks[pointer] = hook
+	return pointer
+
+def hook_signal(signal, callback, data):
+	_count('hook_signal')
+	return _hook('signal', signal, callback, data)
+
+def hook_timer(interval, align_second, max_calls, callback, data):
+	_count('hook_timer')
+	pointer = _hook('timer', interval, callback, data)
+	timers.append((now + interval, pointer, callback, data))
+	return pointer
+
+def hook_config(option, callback, data):
+	return _hook('config', option, callback, data)
+
+def hook_command(command, description, args, args_description, completion, callback, data):
+	return _hook('command', command, callback, data)
+
+def hook_completion(name, description, callback, data):
+	return _hook('completion', name, callback, data)
+
+def hook_info(name, description, args_description, callback, data):
+	infos[name] = (callback, data)
+	return _hook('info', name, callback, data)
+
+def unhook(pointer):
+	_count('unhook')
+	hooks.pop(pointer, None)
+	for timer in list(timers):
+		if timer[1] == pointer: timers.remove(timer)
+
+def completion_list_add(completion, word, nick_completion, where):
+	pass
+
+
+# Configuration.
+
+class Option(object):
+	def __init__(self, name, type, value):
+		self.name  = name
+		self.type  = type
+		self.value = value
+
+def config_new(name, callback, data):
+	return name
+
+def config_new_section(config_file, name, *args):
+	return '{0}.{1}'.format(config_file, name)
+
+def config_new_option(config_file, section, name, type, description, string_values, min, max, default, value, null_allowed, *callbacks):
+	full_name = '{0}.{1}'.format(section, name)
+	options[full_name] = Option(full_name, type, value)
+	return full_name
+
+def config_read(config_file):
+	return WEECHAT_RC_OK
+
+def config_write(config_file):
+	return WEECHAT_RC_OK
+
+def config_free(config_file):
+	pass
+
+def config_string(option):
+	return options[option].value
+
+def config_integer(option):
+	return int(options[option].value)
+
+def config_boolean(option):
+	return 1 if options[option].value in ('on', 'true', '1', 1, True) else 0
+
+def config_option_set(option, value, run_callback):
+	options[option].value = value
+	if run_callback:
+		for hook in list(hooks.values()):
+			if hook[0] == 'config':
+				_callback(hook[2])(hook[3], option, value)
+	return WEECHAT_CONFIG_OPTION_SET_OK_CHANGED
+
+def config_get(name):
+	return name if name in options else ''
+
+
+# Buffers and hdata.
+
+def hdata_get(name):
+	return 'hdata_' + name
+
+def hdata_get_list(hdata, name):
+	_count('hdata_get_list')
+	return buffers[0].pointer if buffers else ''
+
+def _hdata_buffer(pointer):
+	buffer = find_buffer(pointer)
+	if buffer is None: raise ValueError('invalid buffer pointer: {0}'.format(pointer))
+	return buffer
+
+def hdata_integer(hdata, pointer, name):
+	_count('hdata_integer')
+	return getattr(_hdata_buffer(pointer), name)
+
+def hdata_string(hdata, pointer, name):
+	_count('hdata_string')
+	return getattr(_hdata_buffer(pointer), name)
+
+def hdata_pointer(hdata, pointer, name):
+	_count('hdata_pointer')
+	buffer = _hdata_buffer(pointer)
+	if name == 'next_buffer':
+		index = _position(buffer) + 1
+		return buffers[index].pointer if index < len(buffers) else ''
+	if name == 'prev_buffer':
+		index = _position(buffer) - 1
+		return buffers[index].pointer if index >= 0 else ''
+	return ''
+
+def hdata_hashtable(hdata, pointer, name):
+	_count('hdata_hashtable')
+	return dict(_hdata_buffer(pointer).localvars)
+
+def buffer_get_string(pointer, name):
+	_count('buffer_get_string')
+	buffer = _hdata_buffer(pointer)
+	if name.startswith('localvar_'): return buffer.localvars.get(name[len('localvar_'):], '')
+	if name == 'input': return ''
+	return getattr(buffer, name, '')
+
+def buffer_get_integer(pointer, name):
+	return getattr(_hdata_buffer(pointer), name, 0)
+
+def buffer_set(pointer, name, value):
+	_count('buffer_set')
+	if name != 'number': return
+	buffer = _hdata_buffer(pointer)
+	old    = buffer.number
+	new    = max(1, min(int(value), buffers[-1].number))
+	if new == old: return
+	for other in buffers:
+		if other.number == old:
+			other.number = new
+		elif old < new and old < other.number <= new:
+			other.number -= 1
+		elif new < old and new <= other.number < old:
+			other.number += 1
+	_changed()
+	buffers.sort(key=lambda buffer: buffer.number)
+	send_signal('buffer_moved', pointer)
+
+
+# A simplified version of the weechat eval engine.
+
+def _find_close(text, start):
+	''' Find the closing brace of the ${ at text[start - 2:start]. '''
+	level = 1
+	i = start
+	while i < len(text):
+		if text.startswith('${', i):
+			level += 1
+			i += 2
+			continue
+		if text[i] == '}':
+			level -= 1
+			if level == 0: return i
+		i += 1
+	return -1
+
+def _find_level(text, needle):
+	''' Find needle in text outside of ${...}. '''
+	level = 0
+	i = 0
+	while i < len(text):
+		if text.startswith('${', i):
+			level += 1
+			i += 2
+			continue
+		if level and text[i] == '}':
+			level -= 1
+		elif not level and text.startswith(needle, i):
+			return i
+		i += 1
+	return -1
+
+def _replace(text, pointers, extra_vars, no_replace_if = True):
+	result = []
+	i = 0
+	while i < len(text):
+		start = text.find('${', i)
+		if start < 0:
+			result.append(text[i:])
+			break
+		result.append(text[i:start])
+		end = _find_close(text, start + 2)
+		if end < 0:
+			result.append(text[start:])
+			break
+		inner = text[start + 2:end]
+		if not inner.startswith('if:'):
+			inner = _replace(inner, pointers, extra_vars)
+		result.append(_variable(inner, pointers, extra_vars))
+		i = end + 1
+	return ''.join(result)
+
+_number = re.compile(r'\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\Z')
+
+def _to_number(value):
+	# Like strtod: an empty string converts to 0 without leaving any unparsed characters.
+	if value == '': return 0.0
+	if _number.match(value): return float(value)
+	return None
+
+def _quoted(value):
+	return value == '' or (len(value) >= 2 and value[0] == '"' and value[-1] == '"')
+
+def _compare(left, operator, right):
+	if not (_quoted(left) and _quoted(right)) and _to_number(left) is not None and _to_number(right) is not None:
+		left, right = _to_number(left), _to_number(right)
+	if operator == '==': return left == right
+	if operator == '!=': return left != right
+	if operator == '=~': return re.search(right, left) is not None
+	if operator == '!~': return re.search(right, left) is None
+	if operator == '<=': return left <= right
+	if operator == '>=': return left >= right
+	if operator == '<': return left < right
+	if operator == '>': return left > right
+
+def _condition(text, pointers, extra_vars):
+	text = text.strip(' ')
+	for operator in ('||', '&&'):
+		pos = _find_level(text, operator)
+		if pos >= 0:
+			left = _condition(text[:pos], pointers, extra_vars)
+			if operator == '||' and left: return True
+			if operator == '&&' and not left: return False
+			return _condition(text[pos + 2:], pointers, extra_vars)
+	for operator in ('=~', '!~', '==', '!=', '<=', '<', '>=', '>'):
+		pos = _find_level(text, operator)
+		if pos >= 0:
+			left  = _replace(text[:pos].strip(' '), pointers, extra_vars)
+			right = text[pos + len(operator):].strip(' ')
+			if operator not in ('=~', '!~'): right = _replace(right, pointers, extra_vars)
+			return _compare(left, operator, right)
+	value = _replace(text, pointers, extra_vars)
+	return value != '' and value != '0'
+
+def _variable(name, pointers, extra_vars):
+	if name in extra_vars: return extra_vars[name]
+	if name.startswith('if:'):
+		body = name[3:]
+		pos  = _find_level(body, '?')
+		if pos < 0: return '1' if _condition(body, pointers, extra_vars) else '0'
+		condition = _condition(body[:pos], pointers, extra_vars)
+		branches  = body[pos + 1:]
+		pos = _find_level(branches, ':')
+		if pos < 0:
+			return _replace(branches, pointers, extra_vars) if condition else ''
+		return _replace(branches[:pos] if condition else branches[pos + 1:], pointers, extra_vars)
+	if name.startswith('info:'):
+		info, _, arguments = name[5:].partition(',')
+		return info_get(info, arguments)
+	buffer = find_buffer(pointers.get('buffer', ''))
+	if buffer is not None and name in buffer.localvars: return buffer.localvars[name]
+	if name.startswith('buffer.') and buffer is not None:
+		field = name[len('buffer.'):]
+		if field.startswith('local_variables.'):
+			return buffer.localvars.get(field[len('local_variables.'):], '')
+		if field in ('full_name', 'name', 'short_name'):
+			return getattr(buffer, field)
+		if field in ('number', 'hidden'):
+			return str(getattr(buffer, field))
+	return ''
+
+def string_eval_expression(expression, pointers, extra_vars, options):
+	_count('string_eval_expression')
+	return _replace(expression, pointers, extra_vars)
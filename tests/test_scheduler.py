@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#
+# Tests for the SortScheduler of autosort, driven by a fake clock and timers.
+#
+# Autosort is imported with the stand-in weechat module from the bench directory.
+# Run with `python -m pytest tests` or `python -m unittest discover tests`.
+#
+
+import os
+import sys
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'bench'))
+
+import autosort
+
+SortScheduler = autosort.SortScheduler
+
+
+class FakeTimers:
+	''' A fake clock in milliseconds with one-shot timers that only fire when the clock is advanced. '''
+	def __init__(self):
+		self.now    = 0
+		self.next   = 0
+		self.timers = {}
+
+	def clock(self):
+		return self.now
+
+	def start(self, timeout):
+		self.next += 1
+		self.timers[self.next] = self.now + timeout
+		return self.next
+
+	def cancel(self, timer):
+		del self.timers[timer]
+
+	def advance(self, milliseconds, scheduler):
+		''' Move the clock forward, firing the timers that expire on the way in order. '''
+		end = self.now + milliseconds
+		while self.timers:
+			timer, deadline = min(self.timers.items(), key=lambda item: item[1])
+			if deadline > end: break
+			del self.timers[timer]
+			self.now = max(self.now, deadline)
+			scheduler.on_timer()
+		self.now = end
+
+
+class SchedulerTest(unittest.TestCase):
+	def setUp(self):
+		self.timers    = FakeTimers()
+		self.sorts     = []
+		self.result    = None
+		self.scheduler = SortScheduler(self.sort, self.timers.start, self.timers.cancel, self.timers.clock)
+		self.scheduler.configure(5, 100)
+
+	def sort(self):
+		self.sorts.append(self.timers.now)
+		return self.result
+
+	def advance(self, milliseconds):
+		self.timers.advance(milliseconds, self.scheduler)
+
+	def test_single_signal(self):
+		self.scheduler.signal('buffer_opened')
+		self.assertEqual(self.scheduler.state, SortScheduler.DELAYING)
+		self.advance(5)
+		self.assertEqual(self.sorts, [5])
+		self.assertEqual(self.scheduler.state, SortScheduler.HOLDOFF)
+		self.advance(100)
+		self.assertEqual(self.scheduler.state, SortScheduler.IDLE)
+		self.assertEqual(self.timers.timers, {})
+
+	def test_burst_of_signals_has_one_timer(self):
+		for i in range(200):
+			self.scheduler.signal('buffer_opened')
+			self.assertLessEqual(len(self.timers.timers), 1)
+			self.advance(1)
+		self.advance(1000)
+		self.assertLessEqual(len(self.sorts), 3)
+		self.assertEqual(self.scheduler.state, SortScheduler.IDLE)
+		self.assertEqual(self.timers.timers, {})
+
+	def test_one_queued_sort_during_holdoff(self):
+		self.scheduler.signal('buffer_opened')
+		self.advance(5)
+		self.assertEqual(self.scheduler.state, SortScheduler.HOLDOFF)
+		self.assertTrue(self.scheduler.signal('buffer_opened'))
+		for i in range(10):
+			self.assertFalse(self.scheduler.signal('buffer_opened'))
+		self.assertEqual(len(self.timers.timers), 1)
+		self.advance(100)
+		self.assertEqual(self.sorts, [5, 105])
+		self.advance(1000)
+		self.assertEqual(self.sorts, [5, 105])
+		self.assertEqual(self.scheduler.state, SortScheduler.IDLE)
+
+	def test_sort_finished_without_sort_limit(self):
+		self.scheduler.configure(5, 0)
+		self.scheduler.signal('buffer_opened')
+		self.advance(5)
+		self.assertEqual(self.sorts, [5])
+		self.assertEqual(self.scheduler.state, SortScheduler.IDLE)
+		self.assertEqual(self.timers.timers, {})
+
+	def test_sort_finished_later_without_sort_limit(self):
+		# A sort that continues in the background, with a signal queued while it runs.
+		self.scheduler.configure(5, 0)
+		self.result = False
+		self.scheduler.signal('buffer_opened')
+		self.advance(5)
+		self.assertEqual(self.scheduler.state, SortScheduler.SORTING)
+		self.scheduler.signal('buffer_opened')
+		self.advance(50)
+		self.scheduler.sort_finished(50)
+		self.assertEqual(self.scheduler.state, SortScheduler.DELAYING)
+		self.result = None
+		self.advance(5)
+		self.assertEqual(self.sorts, [5, 60])
+		self.assertEqual(self.scheduler.state, SortScheduler.IDLE)
+
+	def test_burst(self):
+		self.scheduler.configure(5, 100, burst_quiet = 1000, burst_max = 30000)
+		self.scheduler.begin_burst('server.a')
+		self.assertEqual(self.scheduler.state, SortScheduler.SUSPENDED)
+		for i in range(100):
+			self.scheduler.signal('buffer_opened')
+			self.advance(10)
+		self.assertEqual(self.sorts, [])
+		self.scheduler.end_burst('server.a')
+		self.advance(999)
+		self.assertEqual(self.sorts, [])
+		self.advance(1)
+		self.assertEqual(self.sorts, [2000])
+		self.advance(1000)
+		self.assertEqual(self.scheduler.state, SortScheduler.IDLE)
+
+	def test_burst_waits_for_all_sources(self):
+		self.scheduler.configure(5, 100, burst_quiet = 1000, burst_max = 30000)
+		self.scheduler.begin_burst('server.a')
+		self.scheduler.begin_burst('server.b')
+		self.scheduler.signal('buffer_opened')
+		self.scheduler.end_burst('server.a')
+		self.advance(5000)
+		self.assertEqual(self.sorts, [])
+		self.scheduler.end_burst('server.b')
+		self.advance(1000)
+		self.assertEqual(self.sorts, [6000])
+
+	def test_burst_max_duration(self):
+		self.scheduler.configure(5, 100, burst_quiet = 1000, burst_max = 30000)
+		self.scheduler.begin_burst('server.a')
+		self.scheduler.signal('buffer_opened')
+		self.advance(29999)
+		self.assertEqual(self.sorts, [])
+		self.advance(1)
+		self.assertEqual(self.sorts, [30000])
+		self.assertEqual(self.scheduler.bursts, set())
+
+	def test_burst_without_signals(self):
+		self.scheduler.configure(5, 100, burst_quiet = 1000, burst_max = 30000)
+		self.scheduler.begin_burst('server.a')
+		self.scheduler.end_burst('server.a')
+		self.advance(1000)
+		self.assertEqual(self.sorts, [])
+		self.assertEqual(self.scheduler.state, SortScheduler.IDLE)
+		self.assertEqual(self.timers.timers, {})
+
+	def test_burst_started_while_sorting(self):
+		self.scheduler.configure(5, 100, burst_quiet = 1000, burst_max = 30000)
+		self.result = False
+		self.scheduler.signal('buffer_opened')
+		self.advance(5)
+		self.assertEqual(self.scheduler.state, SortScheduler.SORTING)
+		self.scheduler.begin_burst('server.a')
+		self.scheduler.signal('buffer_opened')
+		self.advance(50)
+		self.scheduler.sort_finished(50)
+		self.assertEqual(self.scheduler.state, SortScheduler.SUSPENDED)
+
+		self.result = None
+		for i in range(100):
+			self.scheduler.signal('buffer_opened')
+			self.advance(10)
+		self.assertEqual(self.sorts, [5])
+		self.scheduler.end_burst('server.a')
+		self.advance(1000)
+		self.assertEqual(self.sorts, [5, 2055])
+
+	def test_burst_started_and_ended_while_sorting(self):
+		self.scheduler.configure(5, 100, burst_quiet = 1000, burst_max = 30000)
+		self.result = False
+		self.scheduler.signal('buffer_opened')
+		self.advance(5)
+		self.scheduler.begin_burst('server.a')
+		self.scheduler.signal('buffer_opened')
+		self.advance(50)
+		self.scheduler.end_burst('server.a')
+		self.advance(400)
+		self.scheduler.sort_finished(450)
+		self.assertEqual(self.scheduler.state, SortScheduler.SUSPENDED)
+		self.result = None
+		self.advance(600)
+		self.assertEqual(self.sorts, [5, 1055])
+
+	def test_burst_over_before_sort_finished(self):
+		self.scheduler.configure(5, 100, burst_quiet = 1000, burst_max = 2000)
+		self.result = False
+		self.scheduler.signal('buffer_opened')
+		self.advance(5)
+		self.scheduler.begin_burst('server.a')
+		self.advance(3000)
+		self.scheduler.sort_finished(3000)
+		self.assertEqual(self.scheduler.state, SortScheduler.HOLDOFF)
+		self.assertEqual(self.scheduler.bursts, set())
+
+	def test_burst_disabled(self):
+		self.scheduler.configure(5, 100, burst_quiet = 0, burst_max = 30000)
+		self.scheduler.begin_burst('server.a')
+		self.scheduler.signal('buffer_opened')
+		self.advance(5)
+		self.assertEqual(self.sorts, [5])
+
+
+if __name__ == '__main__':
+	unittest.main()